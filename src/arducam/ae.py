@@ -0,0 +1,163 @@
+import json
+from array import array
+
+from .arducam import RESOLUTION_96X96
+from .arducam import CAM_IMAGE_PIX_FMT_YUV
+from .kernels import luma_yuv422
+from .kernels import histogram16
+
+# software auto exposure, sets the manual exposure/gain registers from the luma histogram
+# of a tiny raw preview frame.  converges in one or two frames, where the sensor's own
+# auto modes need several settle frames after every power up or resolution change.
+# the last good settings per resolution are kept in a file so the next wake starts converged.
+# agc is a gain table index (0~30) on the 3mp and the raw 10 bit gain on the 5mp, the gain
+# steps follow the sensor whoami() found
+#   ae = AutoExposure()
+#   if not await ae.restore(arducam):
+#       await ae.converge(arducam)
+class AutoExposure():
+    def __init__(self, target       = 110,  # mean luma
+                       tolerance    = 12,   # close enough to target
+                       min_exposure = 10,
+                       max_exposure = 1400,
+                       max_agc      = None, # default 30 on the 3mp, 0x3ff on the 5mp
+                       agc_step     = None, # default 1 on the 3mp, 16 (~1x gain) on the 5mp
+                       path         = 'ae.json', # None to not persist
+                       ):
+        self.target       = target
+        self.tolerance    = tolerance
+        self.min_exposure = min_exposure
+        self.max_exposure = max_exposure
+        self.max_agc      = max_agc
+        self.agc_step     = agc_step
+        self.path         = path
+
+        self.hist = array('I', [0]*16)
+
+        # str(resolution) -> [exposure, agc], str keys so it round trips through json
+        self.good = {}
+        self.load()
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                self.good = json.load(f)
+        except OSError:
+            pass # first wake
+        except ValueError:
+            pass # corrupt, we'll converge again
+
+    def save(self):
+        if not self.path:
+            return
+        with open(self.path, 'w') as f:
+            json.dump(self.good, f)
+
+    def measure(self, luma):
+        # mean luma and fraction of clipped (top bin) pixels of a luma plane
+        hist = self.hist
+        for i in range(16):
+            hist[i] = 0
+        n = len(luma)
+        histogram16(luma, n, hist)
+        acc = 0
+        for i in range(16):
+            acc += hist[i] * (i*16 + 8)
+        return (acc//n, hist[15]/n)
+
+    def gain_steps(self, arducam):
+        # (agc step, max agc) for the connected sensor
+        if arducam.is_3mp:
+            return (self.agc_step or 1, self.max_agc or 30)
+        return (self.agc_step or 16, self.max_agc or 0x3ff)
+
+    def step(self, mean, clipped, exposure, agc, agc_step = 1, max_agc = 30):
+        # one proportional step toward the target -> (is_good, exposure, agc)
+        if abs(mean - self.target) <= self.tolerance and clipped < 0.05:
+            return (True, exposure, agc)
+        if clipped >= 0.05:
+            # blown out, the mean under reads.  back off hard
+            gain = 0.5
+        else:
+            gain = self.target / max(mean, 1)
+        want = int(exposure * gain)
+        if want > self.max_exposure and agc < max_agc:
+            agc = min(agc + agc_step, max_agc) # out of exposure, add gain
+        elif want < self.min_exposure and agc > 0:
+            agc = max(agc - agc_step, 0)
+        exposure = min(max(want, self.min_exposure), self.max_exposure)
+        return (False, exposure, agc)
+
+    async def feedback(self, arducam, luma):
+        # one step from the luma of a frame already captured at the configured settings,
+        # ie. the dc thumbnail of the last jpeg (arducam.thumb), no preview capture.
+        # returns True if it was on target
+        settings = arducam.settings
+        (mean, clipped) = self.measure(luma)
+        (agc_step, max_agc) = self.gain_steps(arducam)
+        (is_good, exposure, agc) = self.step(mean, clipped, settings['exposure'], settings['agc'],
+                                             agc_step, max_agc)
+        if is_good:
+            key = str(settings['resolution'])
+            if self.good.get(key) != [exposure, agc]:
+                self.good[key] = [exposure, agc]
+                self.save()
+            return True
+        await arducam.update(exposure_is_auto = False,
+                             exposure         = exposure,
+                             agc_is_auto      = False,
+                             agc              = agc,
+                             )
+        return False
+
+    async def restore(self, arducam):
+        # apply the last good settings for the configured resolution, False if we have none
+        good = self.good.get(str(arducam.settings['resolution']))
+        if not good:
+            return False
+        await arducam.update(exposure_is_auto = False,
+                             exposure         = good[0],
+                             agc_is_auto      = False,
+                             agc              = good[1],
+                             )
+        return True
+
+    async def converge(self, arducam, max_frames = 3):
+        # meter on a 96x96 yuv preview and adjust exposure/gain in proportion to the error
+        # the caller's resolution/format are restored after, the settings are remembered
+        # for that resolution
+        settings = arducam.settings
+        resolution   = settings['resolution']
+        pixel_format = settings['pixel_format']
+        exposure = settings['exposure']
+        agc      = settings['agc']
+        (agc_step, max_agc) = self.gain_steps(arducam)
+        is_good = False
+        for x in range(max_frames):
+            await arducam.update(resolution       = RESOLUTION_96X96,
+                                 pixel_format     = CAM_IMAGE_PIX_FMT_YUV,
+                                 exposure_is_auto = False,
+                                 exposure         = exposure,
+                                 agc_is_auto      = False,
+                                 agc              = agc,
+                                 )
+            mv = await arducam.capture_raw()
+            luma_yuv422(mv, mv, 96*96)
+            (mean, clipped) = self.measure(mv[:96*96])
+            # print('ae', exposure, agc, mean, clipped)
+            (is_good, exposure, agc) = self.step(mean, clipped, exposure, agc, agc_step, max_agc)
+            if is_good:
+                break
+
+        await arducam.update(resolution   = resolution,
+                             pixel_format = pixel_format,
+                             exposure     = exposure,
+                             agc          = agc,
+                             )
+        key = str(resolution)
+        if is_good and self.good.get(key) != [exposure, agc]:
+            self.good[key] = [exposure, agc]
+            self.save()
+        return is_good
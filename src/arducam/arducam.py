@@ -4,9 +4,14 @@ import asyncio
 from micropython import const
 
 import time
-from machine import Pin
 import binascii
 import os
+import collections
+
+from . import defs as arducam_defs
+from .jpeg import find_jpeg
+from . import timing as arducam_timing
+from .timing import CaptureTiming
 
 # CAMERA SENSOR ID
 _CAM_REG_SENSOR_ID = const(0x40)
@@ -38,9 +43,20 @@ _CAP_DONE_MASK = const(0x04)
 _SINGLE_FIFO_READ = const(0x3D)
 _BURST_FIFO_READ = const(0X3C)
 _FIFO_BURST_READ_MAX_LENGTH = const(255)
+_FIFO_STREAM_CHUNK_LENGTH = const(2040) # 8 bursts, small fixed buffer when streaming the fifo
+_FIFO_YIELD_LENGTH = const(4096) # default bytes between asyncio yields during readout
+_CAPTURE_POLL_MS = const(2) # fine poll for capture done, once we are near the predicted time
+_CAPTURE_STATS_MAX = const(16) # (resolution, exposure bucket) keys learnt, least used evicted
+_EXPOSURE_BUCKET_SHIFT = const(6) # manual exposures this close share their capture stats
+_B_BURST_FIFO_READ = bytes([_BURST_FIFO_READ])
 _FIFO_SIZE1 = const(0x45)
 _FIFO_SIZE2 = const(0x46)
 _FIFO_SIZE3 = const(0x47)
+_FIFO_MAX_LENGTH = const(0x7fffff) # 3 size bytes, a full fifo has overflowed
+
+# register batches, see transact()
+_OPS_ARM         = ((_ARDUCHIP_FIFO, _FIFO_CLEAR_ID_MASK), (_ARDUCHIP_FIFO, _FIFO_START_MASK))
+_OPS_FIFO_LENGTH = ((_FIFO_SIZE1, None), (_FIFO_SIZE2, None), (_FIFO_SIZE3, None))
 
 # capture mode
 _CAM_SET_CAPTURE_MODE = const(0)
@@ -51,11 +67,22 @@ RESOLUTION_800X600 = const(0x03) # CAM_IMAGE_MODE_SVGA
 RESOLUTION_96X96 = const(0X0a)
 RESOLUTION_128X128 = const(0X0b)
 RESOLUTION_320X320 = const(0X0c)
+# resolution -> (width, height)
+RESOLUTIONS = {
+    RESOLUTION_320X240 : (320, 240),
+    RESOLUTION_640X480 : (640, 480),
+    RESOLUTION_800X600 : (800, 600),
+    RESOLUTION_96X96   : (96, 96),
+    RESOLUTION_128X128 : (128, 128),
+    RESOLUTION_320X320 : (320, 320),
+}
 
 # video mode
 _CAM_SET_VIDEO_MODE   = const(0x80)
 _CAM_VIDEO_MODE_0 = const(1) # 320x240 
 _CAM_VIDEO_MODE_1 = const(2) # 640x480 
+VIDEO_MODE_320X240 = const(_CAM_VIDEO_MODE_0)
+VIDEO_MODE_640X480 = const(_CAM_VIDEO_MODE_1)
 
 # pixel format
 _CAM_REG_FORMAT = const(0x20)
@@ -63,6 +90,12 @@ CAM_IMAGE_PIX_FMT_JPG    = const(0x01)
 CAM_IMAGE_PIX_FMT_RGB565 = const(0x02) # https://rgbcolorpicker.com/565
 CAM_IMAGE_PIX_FMT_YUV = const(0x03)
 
+# jpeg quality, lower quality is smaller frames
+_CAM_REG_IMAGE_QUALITY = const(0x2A)
+IMAGE_QUALITY_HIGH    = const(0x00)
+IMAGE_QUALITY_DEFAULT = const(0x01)
+IMAGE_QUALITY_LOW     = const(0x02)
+
 # color
 _CAM_REG_COLOR_EFFECT_CONTROL = const(0x27)
 SPECIAL_NORMAL = const(0x00)
@@ -95,12 +128,140 @@ CAM_WHITE_BALANCE_MODE_CLOUDY              = const(0x03)
 CAM_WHITE_BALANCE_MODE_HOME                = const(0x04)
 
 
+# a frame from ArduCam.stream()
+Frame = collections.namedtuple('Frame',
+    [
+        'seq',   # sequence number, jumps when frames were dropped for being late
+        'ticks', # time.ticks_ms when the frame came out of the fifo
+        'jpg',   # memoryview, valid until the next frame(s) per ArduCam.capture()
+    ]
+)
+
+class VideoStream():
+    # continuous video mode capture, see ArduCam.stream()
+    #   async with arducam.stream(mode = VIDEO_MODE_640X480, interval_ms = 200) as frames:
+    #       async for frame in frames:
+    # plain "async for frame in arducam.stream()" works too, call stop() to go back to
+    # still capture mode
+    def __init__(self, arducam,
+                       mode        = VIDEO_MODE_320X240,
+                       interval_ms = 0,    # frame pacing, 0 as fast as possible
+                       drop_late   = True, # when we fall behind, skip the missed slots instead of bursting
+                       ):
+        self.arducam     = arducam
+        self.mode        = mode
+        self.interval_ms = interval_ms
+        self.drop_late   = drop_late
+
+        self.is_started = False
+        self.seq        = 0
+        self.next_ticks = 0
+
+        #stats
+        self.dropped    = 0 # slots skipped for being late
+        self.rejected   = 0 # corrupt frames, see ArduCamFrameError
+        self.timeouts   = 0 # captures that never completed, see ArduCamTimeout
+
+    async def start(self):
+        await self.arducam.start_video(self.mode)
+        self.is_started = True
+        self.next_ticks = time.ticks_ms()
+
+    async def stop(self):
+        if self.is_started:
+            self.is_started = False
+            await self.arducam.stop_video()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.stop()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.is_started:
+            await self.start()
+        while True:
+            interval_ms = self.interval_ms
+            if interval_ms:
+                wait = time.ticks_diff(self.next_ticks, time.ticks_ms())
+                if wait > 0:
+                    await asyncio.sleep_ms(wait)
+                elif self.drop_late and -wait >= interval_ms:
+                    missed = -wait // interval_ms
+                    self.dropped += missed
+                    self.seq += missed
+                    self.next_ticks = time.ticks_add(self.next_ticks, missed*interval_ms)
+                self.next_ticks = time.ticks_add(self.next_ticks, interval_ms)
+            self.seq += 1
+            try:
+                jpg = await self.arducam.capture()
+            except arducam_defs.ArduCamFrameError:
+                self.rejected += 1
+                continue
+            except arducam_defs.ArduCamTimeout:
+                # snap() disarmed before waiting, the next capture() re-arms
+                self.timeouts += 1
+                continue
+            return Frame(seq   = self.seq,
+                         ticks = time.ticks_ms(),
+                         jpg   = jpg,
+                         )
+
+class RawRows():
+    # async iterator over the rows of a raw (rgb565/yuv) frame straight out of the fifo,
+    # yields (y, mv) with mv one row of width*bpp bytes, valid until the next row.
+    # the frame is never held in ram, see ArduCam.rows()
+    def __init__(self, arducam, width, height, bpp, buf):
+        self.arducam = arducam
+        self.height  = height
+        self.row_len = width*bpp
+        self.mv      = memoryview(buf)[:self.row_len]
+        self.y       = -1 # -1 until snapped
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.y == -1:
+            read_size = await self.arducam.snap()
+            if read_size < self.row_len*self.height:
+                raise arducam_defs.ArduCamFrameError('short raw frame {}B'.format(read_size))
+        self.y += 1
+        if self.y >= self.height:
+            raise StopAsyncIteration
+        await self.arducam.burst_read(self.mv, is_first = self.y == 0)
+        return (self.y, self.mv)
+
 class ArduCam():
     def __init__(self, spi,
                        cs,
+                       double_buffer = False, # expose the next frame while the last is being sent
+                       burst_len     = _FIFO_BURST_READ_MAX_LENGTH, # fifo bytes per cs assertion
+                       yield_len     = _FIFO_YIELD_LENGTH,  # fifo bytes between asyncio yields, 0 never yields
+                       timing_len    = 32,  # captures kept for per phase timing, 0 disables
+                       bus_lock      = None,# asyncio Lock when the spi bus is shared, see arducam.multi
+                       context       = None,# threadsafe.Context, run fifo readouts on its thread
+                       spi_mutex     = None,# _thread lock shared by cameras on one bus with a context
                        ):
         self.spi = spi
         self.cs  = cs
+        # register ops are single cs assertions and never interleave on the bus, fifo
+        # readouts hold the lock so another camera's frame isn't read out in between
+        self.bus_lock = bus_lock
+
+        # threaded readout, the burst loop runs on the context's thread and the event loop
+        # keeps running.  every spi transaction then holds spi_mutex, so register ops from
+        # this thread can't land in the middle of a burst
+        self.context = context
+        if context and spi_mutex == None:
+            import _thread
+            spi_mutex = _thread.allocate_lock()
+        self.spi_mutex = spi_mutex
 
         # re-use this scratch bytearray to avoid extraneous allocations in read/write functions
         self.scratch  = memoryview(bytearray(8))
@@ -110,8 +271,52 @@ class ArduCam():
         # should this be in a context to enforce?
         self.raw      = bytearray(1024)
 
+        # ping-pong buffers when double buffered.  once the fifo is drained into one buffer
+        # the fifo is re-armed so the sensor exposes the next frame while the caller is busy
+        # with this one.  the caller must be done with a frame before capturing twice more
+        self.double_buffer = double_buffer
+        self.raws     = [self.raw, bytearray(1024)] if double_buffer else [self.raw]
+        self.raw_idx  = 0
+        self.is_armed = False # a capture was started and hasn't been read yet
+
+        # fifo burst reader.  the c sdk limits bursts to 255 bytes, longer bursts under
+        # a single cs assertion save the per-burst command overhead if the firmware allows
+        self.burst_len = burst_len
+        self.yield_len = yield_len
+        # (burst_len, yield_len) -> [bytes, us], see fifo_rates()
+        self.fifo_stats = {}
+
+        # current video mode, None in still capture mode.  see stream()
+        self.video_mode = None
+
+        # capture done latency (ms from arm) by (resolution, exposure)
+        # key -> [count, min, max, sum, ema], see wait_capture_done() and capture_latency()
+        self.capture_stats = {}
+        self.arm_ticks     = 0
+
+        # per phase us of the last timing_len captures, see arducam.timing
+        self.timing = CaptureTiming(size = timing_len) if timing_len else None
+
+        # frame rate counter, see fps()
+        self.frame_count = 0
+        self.fps_ticks   = time.ticks_ms()
+
+        # small fixed buffer when streaming the fifo out in chunks (read_fifo), the full
+        # frame is never held in ram
+        self.chunk    = bytearray(_FIFO_STREAM_CHUNK_LENGTH)
+
         self.is_3mp = False
 
+        # batch register ops, only wait for the sensor to go idle where needed (transact)
+        self.batch = True
+        self.waitidle_us = 0 # total time spent waiting for the sensor
+
+        # shadow copy of the sensor registers configure() has written, so re-configuring
+        # only sends what changed.  see replay() and update()
+        self.shadow   = {}
+        self.settings = None # last configure() kwargs
+        self.presets  = {}   # name -> [kwargs, (register table, settings) or None], see preset()
+
     async def start(self, timeout = 2000):
         await self.connect()
 
@@ -138,9 +343,12 @@ class ArduCam():
                 break
             delta = time.ticks_diff(time.ticks_ms(), t)
             if delta > timeout:
-                raise Exception('timed out connecting to ArduCam : 0x{:02X}'.format(r))
+                raise arducam_defs.ArduCamTimeout('timed out connecting to ArduCam : 0x{:02X}'.format(r))
             await asyncio.sleep_ms(10)
         print('connected to arducam {}'.format(r))
+        self.shadow.clear() # sensor reset, registers are back to defaults
+        for preset in self.presets.values():
+            preset[1] = None # compiled for the sensor, it may be another one now
         await self.write(_CAM_REG_SENSOR_RESET, _CAM_SENSOR_RESET_ENABLE)
         await self.write(_CAM_REG_DEBUG_DEVICE_ADDRESS, _CAM_DEVICE_ADDRESS)
 
@@ -152,102 +360,302 @@ class ArduCam():
         elif r == _SENSOR_3MP_1:
             self.is_3mp = True
             return b'3MP'
-        elif r == _SENSOR_3MP_2:
+        elif r == _SENSOR_5MP_2:
             return b'5MP'
         elif r == _SENSOR_3MP_2:
             self.is_3mp = True
             return b'3MP'
         return r
 
-    async def configure(self, resolution   = RESOLUTION_96X96,
-                              wb_is_auto   = True,
-                              wb_mode      = CAM_WHITE_BALANCE_MODE_HOME,
-                              agc_is_auto  = False,
-                              agc          = 10,
-                              exposure_is_auto = False,
-                              exposure     = 1200,
-                              color        = SPECIAL_NORMAL,
-                              brightness   = BRIGHTNESS_DEFAULT,
-                              contrast     = CONTRAST_DEFAULT,
-                              pixel_format = CAM_IMAGE_PIX_FMT_JPG,
-                              ):
-        await self.write(_CAM_REG_CAPTURE_RESOLUTION, resolution | _CAM_SET_CAPTURE_MODE)
+    async def configure(self, **kwargs):
+        # see compile() for the settings and their defaults
+        (table, settings) = self.compile(**kwargs)
+        self.settings = settings
+        await self.replay(table)
+
+    def preset(self, name, **kwargs):
+        # compile configure() settings once under a name, apply(name) switches to them
+        # ie. arducam.preset('preview', resolution = RESOLUTION_96X96, pixel_format = CAM_IMAGE_PIX_FMT_YUV)
+        #     arducam.preset('still', resolution = RESOLUTION_640X480)
+        # compiled on the first apply(), the gain registers depend on the sensor connect() found
+        self.presets[name] = [kwargs, None]
+
+    async def apply(self, name):
+        # switch to a preset, only the registers that differ are written
+        preset = self.presets[name]
+        if preset[1] == None:
+            preset[1] = self.compile(**preset[0])
+        (table, settings) = preset[1]
+        self.settings = settings
+        await self.replay(table)
+
+    def compile(self, resolution   = RESOLUTION_96X96,
+                      wb_is_auto   = True,
+                      wb_mode      = CAM_WHITE_BALANCE_MODE_HOME,
+                      agc_is_auto  = False,
+                      agc          = 10,
+                      exposure_is_auto = False,
+                      exposure     = 1200,
+                      color        = SPECIAL_NORMAL,
+                      brightness   = BRIGHTNESS_DEFAULT,
+                      contrast     = CONTRAST_DEFAULT,
+                      pixel_format = CAM_IMAGE_PIX_FMT_JPG,
+                      quality      = IMAGE_QUALITY_DEFAULT,
+                      ):
+        # configure() settings -> (register table, settings), the table is bytes of
+        # (reg, value) pairs in the order they are written, see replay()
+        settings = {
+            'resolution'       : resolution,
+            'wb_is_auto'       : wb_is_auto,
+            'wb_mode'          : wb_mode,
+            'agc_is_auto'      : agc_is_auto,
+            'agc'              : agc,
+            'exposure_is_auto' : exposure_is_auto,
+            'exposure'         : exposure,
+            'color'            : color,
+            'brightness'       : brightness,
+            'contrast'         : contrast,
+            'pixel_format'     : pixel_format,
+            'quality'          : quality,
+        }
+
+        ops = [(_CAM_REG_CAPTURE_RESOLUTION, resolution | _CAM_SET_CAPTURE_MODE)]
 
         # white balance
         if wb_is_auto:
-            await self.write(_CAM_REG_EXPOSURE_GAIN_WHILEBALANCE_CONTROL, _SET_AUTO_ON | _SET_WHILEBALANCE)
-            await self.write(_CAM_REG_WHILEBALANCE_MODE_CONTROL, wb_mode)
+            ops.append((_CAM_REG_EXPOSURE_GAIN_WHILEBALANCE_CONTROL, _SET_AUTO_ON | _SET_WHILEBALANCE))
+            ops.append((_CAM_REG_WHILEBALANCE_MODE_CONTROL, wb_mode))
         else:
-            await self.write(_CAM_REG_EXPOSURE_GAIN_WHILEBALANCE_CONTROL, _SET_AUTO_OFF | _SET_WHILEBALANCE)
+            ops.append((_CAM_REG_EXPOSURE_GAIN_WHILEBALANCE_CONTROL, _SET_AUTO_OFF | _SET_WHILEBALANCE))
 
         # AGC (ISO GAIN)
         if agc_is_auto:
-            await self.write(_CAM_REG_EXPOSURE_GAIN_WHILEBALANCE_CONTROL, _SET_AUTO_ON  | _SET_GAIN)
+            ops.append((_CAM_REG_EXPOSURE_GAIN_WHILEBALANCE_CONTROL, _SET_AUTO_ON  | _SET_GAIN))
         else:
-            await self.write(_CAM_REG_EXPOSURE_GAIN_WHILEBALANCE_CONTROL, _SET_AUTO_OFF  | _SET_GAIN)
+            ops.append((_CAM_REG_EXPOSURE_GAIN_WHILEBALANCE_CONTROL, _SET_AUTO_OFF  | _SET_GAIN))
             if self.is_3mp:
                 agcs = [0x00, 0x10, 0x18, 0x30, 0x34, 0x38, 0x3b, 0x3f, 0x72, 0x74, 0x76,
                                             0x78, 0x7a, 0x7c, 0x7e, 0xf0, 0xf1, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6,
                                             0xf7, 0xf8, 0xf9, 0xfa, 0xfb, 0xfc, 0xfd, 0xfe, 0xff]
                 agc = agcs[agc]
-            await self.write(_CAM_REG_MANUAL_GAIN_BIT_9_8, (agc >> 8)&0xff)
-            await self.write(_CAM_REG_MANUAL_GAIN_BIT_7_0, agc & 0xff)
+            ops.append((_CAM_REG_MANUAL_GAIN_BIT_9_8, (agc >> 8)&0xff))
+            ops.append((_CAM_REG_MANUAL_GAIN_BIT_7_0, agc & 0xff))
 
         # exposure 100~1400
         if exposure_is_auto:
-            await self.write(_CAM_REG_EXPOSURE_GAIN_WHILEBALANCE_CONTROL, _SET_AUTO_ON  | _SET_EXPOSURE)
+            ops.append((_CAM_REG_EXPOSURE_GAIN_WHILEBALANCE_CONTROL, _SET_AUTO_ON  | _SET_EXPOSURE))
         else:
-            await self.write(_CAM_REG_EXPOSURE_GAIN_WHILEBALANCE_CONTROL, _SET_AUTO_OFF  | _SET_EXPOSURE)
-            await self.write(_CAM_REG_MANUAL_EXPOSURE_BIT_19_16, (exposure >> 16)&0xff)
-            await self.write(_CAM_REG_MANUAL_EXPOSURE_BIT_15_8, (exposure>>8) & 0xff)
-            await self.write(_CAM_REG_MANUAL_EXPOSURE_BIT_7_0, exposure & 0xff)
+            ops.append((_CAM_REG_EXPOSURE_GAIN_WHILEBALANCE_CONTROL, _SET_AUTO_OFF  | _SET_EXPOSURE))
+            ops.append((_CAM_REG_MANUAL_EXPOSURE_BIT_19_16, (exposure >> 16)&0xff))
+            ops.append((_CAM_REG_MANUAL_EXPOSURE_BIT_15_8, (exposure>>8) & 0xff))
+            ops.append((_CAM_REG_MANUAL_EXPOSURE_BIT_7_0, exposure & 0xff))
 
         # filter color (special)
-        await self.write(_CAM_REG_COLOR_EFFECT_CONTROL, color)
+        ops.append((_CAM_REG_COLOR_EFFECT_CONTROL, color))
 
         # brightness
-        await self.write(_CAM_REG_BRIGHTNESS_CONTROL, brightness)
+        ops.append((_CAM_REG_BRIGHTNESS_CONTROL, brightness))
 
         # contrast
-        await self.write(_CAM_REG_CONTRAST_CONTROL, contrast)
+        ops.append((_CAM_REG_CONTRAST_CONTROL, contrast))
+
+        # jpeg quality
+        ops.append((_CAM_REG_IMAGE_QUALITY, quality))
 
         # writeReg(camera, CAM_REG_FORMAT, pixel_format); // set the data format
-        await self.write(_CAM_REG_FORMAT, pixel_format)
+        ops.append((_CAM_REG_FORMAT, pixel_format))
+
+        table = bytearray(2*len(ops))
+        for i in range(len(ops)):
+            table[2*i]   = ops[i][0]
+            table[2*i+1] = ops[i][1]
+        return (bytes(table), settings)
+
+    async def update(self, **changes):
+        # change some settings at runtime, only the registers that changed are written
+        # ie. await arducam.update(brightness = 2, exposure = 800)
+        settings = {} if self.settings == None else self.settings.copy()
+        settings.update(changes)
+        await self.configure(**settings)
+
+    async def replay(self, table):
+        # write a register table from compile() in one pass, like the c sdk's register
+        # arrays.  registers that already hold the value (shadow) are skipped and, as in
+        # transact(), we only wait for the sensor to go idle before the next write.
+        # the exposure/gain/wb control register is keyed by its function (lower nibble).
+        # the manual values/modes after a control that changed are always sent, auto mode
+        # may have moved the sensor away from what we last wrote
+        shadow = self.shadow
+        batch = self.batch
+        is_forced = False
+        is_busy = False
+        is_written = False
+        try:
+            for i in range(0, len(table), 2):
+                reg = table[i]
+                v   = table[i+1]
+                if reg == _CAM_REG_EXPOSURE_GAIN_WHILEBALANCE_CONTROL:
+                    key = (reg<<8) | (v&0x0f)
+                    is_forced = shadow.get(key) != v
+                else:
+                    key = reg
+                    if reg != _CAM_REG_WHILEBALANCE_MODE_CONTROL and\
+                       (reg < _CAM_REG_MANUAL_GAIN_BIT_9_8 or reg > _CAM_REG_MANUAL_EXPOSURE_BIT_7_0):
+                        is_forced = False
+                if not is_forced and shadow.get(key) == v:
+                    continue
+                if is_busy:
+                    await self.waitidle()
+                shadow[key] = v
+                self._write(reg, v)
+                is_busy = True
+                is_written = True
+                if not batch:
+                    await self.waitidle()
+                    is_busy = False
+            if is_busy:
+                await self.waitidle()
+        except:
+            self.shadow.clear() # don't know what made it to the sensor
+            raise
 
-    async def capture(self):
-        await self.write(_ARDUCHIP_FIFO, _FIFO_CLEAR_ID_MASK)
-        await self.write(_ARDUCHIP_FIFO, _FIFO_START_MASK)
-        for x in range(30):
-            r = await self.read(_ARDUCHIP_TRIG)
+        if is_written:
+            # a frame armed before the change was taken with the old settings
+            self.is_armed = False
+
+    def stream(self, mode        = VIDEO_MODE_320X240,
+                     interval_ms = 0,
+                     drop_late   = True,
+                     ):
+        # continuous video mode, async iterator of Frame.  the sensor keeps streaming, so
+        # each frame only costs arm/wait/readout, not a still capture setup
+        return VideoStream(arducam     = self,
+                           mode        = mode,
+                           interval_ms = interval_ms,
+                           drop_late   = drop_late,
+                           )
+
+    async def start_video(self, mode):
+        await self.replay(bytes([_CAM_REG_CAPTURE_RESOLUTION, _CAM_SET_VIDEO_MODE | mode]))
+        self.video_mode = mode
+        self.is_armed = False
+
+    async def stop_video(self):
+        # back to still capture mode at the configured resolution
+        self.video_mode = None
+        self.is_armed = False
+        if self.settings != None:
+            await self.configure(**self.settings)
+
+    async def arm(self):
+        # clear the fifo and start a capture
+        await self.transact(_OPS_ARM)
+        self.arm_ticks = time.ticks_ms()
+        self.is_armed = True
+
+    async def snap(self):
+        # take a picture into the camera fifo, return the number of bytes waiting in the fifo
+        # if the fifo was re-armed after the last frame, the capture is already under way.
+        # an empty or overflowed fifo raises ArduCamFrameError, whatever reads it next
+        timing = self.timing
+        if timing:
+            timing.start()
+        if not self.is_armed:
+            await self.arm()
+            if timing:
+                timing.lap(arducam_timing.PHASE_ARM)
+        self.is_armed = False
+        await self.wait_capture_done()
+        if timing:
+            timing.lap(arducam_timing.PHASE_WAIT)
+
+        read_size = await self.read_fifo_length()
+        if timing:
+            timing.lap(arducam_timing.PHASE_LENGTH)
+        # print('read_size:{}'.format(read_size))
+        self.frame_count += 1
+        if read_size == 0 or read_size >= _FIFO_MAX_LENGTH:
+            raise arducam_defs.ArduCamFrameError('fifo length {}'.format(read_size))
+        return read_size
+
+    async def wait_capture_done(self, timeout = arducam_defs.CAPTURE_TIMEOUT_MS):
+        # sleep until just before this resolution/exposure usually finishes, then poll finely
+        # the typical completion time is learnt from previous captures (ema)
+        ticks_ms = time.ticks_ms
+        ticks_diff = time.ticks_diff
+        settings = self.settings or {}
+        # manual exposures are bucketed, software ae (arducam.ae) writes arbitrary values
+        exposure = None if settings.get('exposure_is_auto', True) else settings.get('exposure', 0) >> _EXPOSURE_BUCKET_SHIFT
+        key = (settings.get('resolution') if self.video_mode == None else _CAM_SET_VIDEO_MODE | self.video_mode,
+               exposure)
+        stat = self.capture_stats.get(key)
+        ahead = 0
+        if stat:
+            ahead = stat[4]*7//8 - ticks_diff(ticks_ms(), self.arm_ticks)
+            if ahead > 0:
+                await asyncio.sleep_ms(ahead)
+        polls = 0
+        while True:
+            r = self._read(_ARDUCHIP_TRIG)
             # print('0x{:02X} {}'.format(r, r & _CAP_DONE_MASK))
             if r & _CAP_DONE_MASK:
                 break
-            await asyncio.sleep_ms(100)
+            elapsed = ticks_diff(ticks_ms(), self.arm_ticks)
+            if elapsed > timeout:
+                raise arducam_defs.ArduCamTimeout('capture not done after {}ms'.format(elapsed))
+            polls += 1
+            await asyncio.sleep_ms(_CAPTURE_POLL_MS)
+
+        if polls == 0:
+            # done on the first look, we only know it finished sooner
+            if ahead > 0:
+                # we slept too long, pull the prediction in
+                stat[4] = stat[4]*3//4
+            # else armed long ago (ie. double buffered), latency unknown
+            return
+        ms = ticks_diff(ticks_ms(), self.arm_ticks)
+        if stat == None:
+            capture_stats = self.capture_stats
+            if len(capture_stats) >= _CAPTURE_STATS_MAX:
+                # bounded on a long running device, the least used key goes
+                del capture_stats[min(capture_stats, key = lambda k: capture_stats[k][0])]
+            capture_stats[key] = [1, ms, ms, ms, ms]
+        else:
+            stat[0] += 1
+            stat[1] = min(stat[1], ms)
+            stat[2] = max(stat[2], ms)
+            stat[3] += ms
+            stat[4] = (stat[4]*3 + ms)//4
+
+    def capture_latency(self):
+        # capture done latency by (resolution, exposure >> 6) -> (count, min, mean, max) ms
+        r = {}
+        for key, stat in self.capture_stats.items():
+            r[key] = (stat[0], stat[1], stat[3]//stat[0], stat[2])
+        return r
 
-        read_size = await self.read_fifo_length()
-        # print('read_size:{}'.format(read_size))
+    def fps(self):
+        # frames/sec since the last call
+        now = time.ticks_ms()
+        delta = time.ticks_diff(now, self.fps_ticks)
+        r = self.frame_count*1000/delta if delta > 0 else 0
+        self.frame_count = 0
+        self.fps_ticks = now
+        return r
+
+    async def capture(self):
+        read_size = await self.snap()
 
         # grow raw array if needed
-        if read_size > len(self.raw):
-            self.raw = bytearray(read_size)
+        raw = self.raws[self.raw_idx]
+        if read_size > len(raw):
+            raw = bytearray(read_size)
+            self.raws[self.raw_idx] = raw
+        self.raw = raw
 
         mv = memoryview(self.raw)
-        b_burst_read = bytes([_BURST_FIFO_READ])
-        for i in range(0, read_size, _FIFO_BURST_READ_MAX_LENGTH):
-            try:
-                self.cs(0)
-                self.spi.write(b_burst_read)
-                if i == 0:
-                    self.spi.write(b'0') # dummy write on first according to spec sheet
-                self.spi.readinto(mv[i:i+_FIFO_BURST_READ_MAX_LENGTH], 0x00)
-            finally:
-                self.cs(1)
-        # print('burst read: {}'.format(len(self.raw)))
-        # self.print_bytes(self.raw)
-
-        start_idx = self.raw.find(b'\xff\xd8') # jpg start flag
-        stop_idx = self.raw.find(b'\xff\xd9')  # jpg stop flag
-        stop_idx += 2
+        # fifo is drained into self.raw, the double buffer flips to the other one
+        (start_idx, stop_idx) = await self.read_jpeg(self.raw, mv, 0, read_size)
         # print('image {}:{}'.format(start_idx, stop_idx))
 
         jpg_mv = mv[start_idx:stop_idx]
@@ -257,6 +665,200 @@ class ArduCam():
         # with open('image.txt', 'w') as f:
             # f.write(binascii.b2a_base64(jpg).decode())
 
+    async def capture_into(self, buf, offset = 0, mv = None):
+        # capture a jpeg straight into buf[offset:], ie. a packet arena slot (mqtt.arena).
+        # returns the (start, stop) of the jpeg in buf.  pass mv, a memoryview of buf, to
+        # allocate nothing.  a frame that doesn't fit raises ArduCamFrameError
+        read_size = await self.snap()
+        if offset + read_size > len(buf):
+            raise arducam_defs.ArduCamFrameError('frame {}B doesn\'t fit {}B'.format(read_size, len(buf) - offset))
+        if mv == None:
+            mv = memoryview(buf)
+        return await self.read_jpeg(buf, mv, offset, read_size)
+
+    async def read_jpeg(self, buf, mv, offset, read_size):
+        # read the snapped frame into buf[offset:offset+read_size] (mv is a view of buf),
+        # re-arm if double buffered and return the (start, stop) of the jpeg in buf
+        timing = self.timing
+        await self.burst_read(mv[offset:offset+read_size], is_first = True)
+        # print('burst read: {}'.format(len(self.raw)))
+        # self.print_bytes(self.raw)
+        if timing:
+            timing.lap(arducam_timing.PHASE_READ)
+
+        if self.double_buffer:
+            # fifo is drained, start exposing the next frame into the other buffer
+            await self.arm()
+            self.raw_idx ^= 1
+            if timing:
+                timing.lap(arducam_timing.PHASE_ARM)
+
+        # only the read_size bytes we just filled, buf may hold an older larger frame
+        r = find_jpeg(buf, offset + read_size, offset)
+        if timing:
+            timing.lap(arducam_timing.PHASE_FIND)
+            timing.commit()
+        return r
+
+    def frame_size(self):
+        # (width, height, bytes per pixel) of a raw frame at the configured resolution
+        settings = self.settings or {}
+        (width, height) = RESOLUTIONS[settings.get('resolution', RESOLUTION_96X96)]
+        bpp = 1 if settings.get('pixel_format', CAM_IMAGE_PIX_FMT_JPG) == CAM_IMAGE_PIX_FMT_JPG else 2
+        return (width, height, bpp)
+
+    async def capture_raw(self):
+        # capture a raw rgb565/yuv422 frame (configure pixel_format), returns a zero copy
+        # memoryview of exactly width*height*2 bytes, see arducam.kernels for processing
+        (width, height, bpp) = self.frame_size()
+        size = width*height*bpp
+        read_size = await self.snap()
+        if read_size < size:
+            raise arducam_defs.ArduCamFrameError('raw fifo length {} expected {}'.format(read_size, size))
+
+        raw = self.raws[self.raw_idx]
+        if size > len(raw):
+            raw = bytearray(size)
+            self.raws[self.raw_idx] = raw
+        self.raw = raw
+
+        timing = self.timing
+        mv = memoryview(self.raw)[:size]
+        await self.burst_read(mv, is_first = True)
+        if timing:
+            timing.lap(arducam_timing.PHASE_READ)
+
+        if self.double_buffer:
+            await self.arm()
+            self.raw_idx ^= 1
+            if timing:
+                timing.lap(arducam_timing.PHASE_ARM)
+        if timing:
+            timing.commit()
+        return mv
+
+    def rows(self):
+        # capture a raw frame and iterate its rows out of the fifo, only one row in ram
+        #   async for (y, row) in arducam.rows():
+        (width, height, bpp) = self.frame_size()
+        row_len = width*bpp
+        buf = self.chunk if row_len <= len(self.chunk) else bytearray(row_len)
+        return RawRows(arducam = self,
+                       width   = width,
+                       height  = height,
+                       bpp     = bpp,
+                       buf     = buf,
+                       )
+
+    async def read_fifo(self, length, sink, buf=None):
+        # stream length bytes out of the fifo (after snap) through a small fixed buffer
+        # each filled chunk is passed to the async sink(mv) before the buffer is re-used,
+        # sink must be done with mv when it returns
+        if buf == None:
+            buf = self.chunk
+        mv = memoryview(buf)
+        chunk_len = len(buf)
+        idx = 0
+        while idx < length:
+            n = min(chunk_len, length - idx)
+            await self.burst_read(mv[:n], is_first = idx == 0)
+            await sink(mv[:n])
+            idx += n
+
+    async def burst_read(self, mv, is_first):
+        # fill mv from the fifo in bursts of burst_len bytes (cs held low for each burst)
+        # yield to asyncio every yield_len bytes so mqtt/socket tasks aren't starved
+        bus_lock = self.bus_lock
+        if bus_lock:
+            async with bus_lock:
+                await self._burst_read(mv, is_first)
+        else:
+            await self._burst_read(mv, is_first)
+
+    async def _burst_read(self, mv, is_first):
+        if self.context:
+            # Context signals the job done with a ThreadSafeFlag, we sleep until then
+            us = await self.context.assign(self._burst_read_thread, mv, is_first)
+            if isinstance(us, Exception):
+                raise us # from the spi on the context thread
+            self._fifo_stat((self.burst_len, 'thread'), len(mv), us)
+            return
+
+        #local access
+        cs = self.cs
+        spi_write = self.spi.write
+        spi_readinto = self.spi.readinto
+        burst_len = self.burst_len
+        yield_len = self.yield_len
+        ticks_us = time.ticks_us
+        ticks_diff = time.ticks_diff
+
+        lenmv = len(mv)
+        since_yield = 0
+        us = 0 # time spent reading, excludes time given to other tasks
+        t = ticks_us()
+        for i in range(0, lenmv, burst_len):
+            try:
+                cs(0)
+                spi_write(_B_BURST_FIFO_READ)
+                if is_first and i == 0:
+                    spi_write(b'0') # dummy write on first according to spec sheet
+                spi_readinto(mv[i:i+burst_len], 0x00)
+            finally:
+                cs(1)
+            since_yield += burst_len
+            if yield_len and since_yield >= yield_len:
+                us += ticks_diff(ticks_us(), t)
+                await asyncio.sleep_ms(0)
+                since_yield = 0
+                t = ticks_us()
+        us += ticks_diff(ticks_us(), t)
+        self._fifo_stat((burst_len, yield_len), lenmv, us)
+
+    def _burst_read_thread(self, mv, is_first):
+        # the burst loop on the context thread, never yields.  the mutex is released between
+        # bursts so the event loop thread can get on the bus.  returns the us spent, or the
+        # exception raised.  one escaping here would end the worker before it signals the
+        # job done, and every later assign() would wait forever
+        #local access
+        cs = self.cs
+        spi_write = self.spi.write
+        spi_readinto = self.spi.readinto
+        mutex = self.spi_mutex
+        burst_len = self.burst_len
+
+        t = time.ticks_us()
+        try:
+            for i in range(0, len(mv), burst_len):
+                with mutex:
+                    try:
+                        cs(0)
+                        spi_write(_B_BURST_FIFO_READ)
+                        if is_first and i == 0:
+                            spi_write(b'0') # dummy write on first according to spec sheet
+                        spi_readinto(mv[i:i+burst_len], 0x00)
+                    finally:
+                        cs(1)
+        except Exception as err:
+            return err
+        return time.ticks_diff(time.ticks_us(), t)
+
+    def _fifo_stat(self, key, length, us):
+        stat = self.fifo_stats.get(key)
+        if stat == None:
+            stat = [0, 0]
+            self.fifo_stats[key] = stat
+        stat[0] += length
+        stat[1] += us
+
+    def fifo_rates(self):
+        # measured fifo readout bytes/sec for each (burst_len, yield_len) used so far
+        # yield_len is 'thread' for readouts on the context thread
+        r = {}
+        for key, stat in self.fifo_stats.items():
+            r[key] = stat[0]*1000000//stat[1] if stat[1] else 0
+        return r
+
     def print_bytes(self, mv):
         stride = 64 
         for i in range(0,len(mv), stride):
@@ -269,45 +871,89 @@ class ArduCam():
             print()
 
     async def read_fifo_length(self):
-        bs = self.scratch[3:7] # read uses lower scratch bytes
-        bs[0] = await self.read(_FIFO_SIZE1)
-        bs[1] = await self.read(_FIFO_SIZE2)
-        bs[2] = await self.read(_FIFO_SIZE3)
-        # print('{} 0x{:02x} 0x{:02x} 0x{:02x}  little:{} big:{}'.format(bs, bs[2], bs[1], bs[0], int.from_bytes(bs, 'little'), int.from_bytes(bs, 'big')))
-        return int.from_bytes(bs, 'little')
-
-    async def read(self, reg, dowait=True):
+        rs = await self.transact(_OPS_FIFO_LENGTH)
+        # print('0x{:02x} 0x{:02x} 0x{:02x}'.format(rs[2], rs[1], rs[0]))
+        return rs[0] | (rs[1]<<8) | (rs[2]<<16)
+
+    async def transact(self, ops):
+        # run a batch of register ops back to back, ops is a sequence of (reg, value)
+        # where value None reads the register.  returns a list of the read values.
+        # like the c sdk, only writes forwarded to the sensor need it to go idle, and we
+        # only wait right before the next op that follows one (or at the end of the batch).
+        # reads and arduchip fifo writes are answered by the mega directly.
+        # with batch = False, wait after every op (as before, for comparison)
+        batch = self.batch
+        rs = []
+        is_busy = False
+        for op in ops:
+            reg = op[0]
+            v   = op[1]
+            if is_busy:
+                await self.waitidle()
+            if v == None:
+                rs.append(self._read(reg))
+                is_busy = not batch
+            else:
+                self._write(reg, v)
+                is_busy = not batch or reg != _ARDUCHIP_FIFO
+        if is_busy:
+            await self.waitidle()
+        return rs
+
+    async def read(self, reg):
+        r = self._read(reg)
+        if not self.batch:
+            await self.waitidle()
+        return r
+
+    async def write(self, reg, v):
+        self._write(reg, v)
+        if not self.batch or reg != _ARDUCHIP_FIFO:
+            await self.waitidle()
+
+    def _read(self, reg):
         rxtx = self.scratch[0:3]
         rxtx[0] = 0x7f & reg
         rxtx[1] = 0
         rxtx[2] = 0
+        mutex = self.spi_mutex
+        if mutex:
+            mutex.acquire()
         try:
             self.cs(0)
             self.spi.write_readinto(rxtx, rxtx)
             r = rxtx[2]
         finally:
             self.cs(1)
-        if dowait:
-            await self.waitidle()
+            if mutex:
+                mutex.release()
         return r
 
-    async def write(self, reg, v):
+    def _write(self, reg, v):
         tx = self.scratch[:2]
         tx[0] = 0x80 | reg
         tx[1] = v
+        mutex = self.spi_mutex
+        if mutex:
+            mutex.acquire()
         try:
             self.cs(0)
             self.spi.write(tx)
         finally:
             self.cs(1)
-        await self.waitidle()
+            if mutex:
+                mutex.release()
 
     async def waitidle(self):
+        t = time.ticks_us()
+        try:
+            await self._waitidle()
+        finally:
+            self.waitidle_us += time.ticks_diff(time.ticks_us(), t)
+
+    async def _waitidle(self):
         for x in range(500):
-            r = await self.read(_CAM_REG_SENSOR_STATE, dowait=False) # this is the wait function!
+            r = self._read(_CAM_REG_SENSOR_STATE) # this is the wait function!
             if r&0x03 == _CAM_REG_SENSOR_STATE_IDLE:
                 break
             await asyncio.sleep_ms(2)
-         
-
-
@@ -0,0 +1,147 @@
+import asyncio
+import sys
+import time
+
+from arducam.arducam import ArduCam
+from arducam.arducam import RESOLUTION_640X480
+from arducam.arducam import RESOLUTION_96X96
+from arducam.arducam import CAM_IMAGE_PIX_FMT_JPG
+from arducam.arducam import CAM_IMAGE_PIX_FMT_YUV
+
+# time a full configure and capture, per register op waitidle (before) vs batched (after)
+#   import arducam.bench
+#   arducam.bench.main()          # on the board
+#   arducam.bench.main(sim=True)  # anywhere, against arducam.sim (ie. unix port on linux)
+# then preview/still mode switches, full configure vs diffed configure vs compiled presets
+# and event loop stalls during captures, fifo readout in the loop vs on a threadsafe.Context
+
+async def bench(arducam, n = 5, sim = None):
+    for batch in (False, True):
+        arducam.batch = batch
+        arducam.waitidle_us = 0
+        if sim:
+            stats = sim.stats()
+
+        t = time.ticks_us()
+        for x in range(n):
+            arducam.shadow.clear() # full configure each time
+            await arducam.configure(resolution = RESOLUTION_640X480)
+        configure_us = time.ticks_diff(time.ticks_us(), t)//n
+
+        if sim:
+            configure_stats = sim.stats()
+        t = time.ticks_us()
+        for x in range(n):
+            jpg_mv = await arducam.capture()
+        capture_us = time.ticks_diff(time.ticks_us(), t)//n
+
+        print('batch:{} configure {}us capture {}us ({}B) waitidle {}us/iteration'.format(
+                batch, configure_us, capture_us, len(jpg_mv), arducam.waitidle_us//n))
+        if sim:
+            now = sim.stats()
+            print('    transactions configure {} capture {} B/s {}'.format(
+                    (configure_stats['transactions'] - stats['transactions'])//n,
+                    (now['transactions'] - configure_stats['transactions'])//n,
+                    (now['bytes'] - configure_stats['bytes'])*1000000//max(1, n*capture_us)))
+    print('fifo B/s {}'.format(arducam.fifo_rates()))
+    print('capture ms {}'.format(arducam.capture_latency()))
+
+async def switch(arducam, n = 10):
+    preview = {'resolution' : RESOLUTION_96X96, 'pixel_format' : CAM_IMAGE_PIX_FMT_YUV}
+    still   = {'resolution' : RESOLUTION_640X480, 'pixel_format' : CAM_IMAGE_PIX_FMT_JPG}
+    arducam.preset('preview', **preview)
+    arducam.preset('still', **still)
+    await arducam.apply('preview') # compiled on first use, not timed
+    await arducam.apply('still')
+    for mode in ('full', 'configure', 'preset'):
+        arducam.waitidle_us = 0
+        t = time.ticks_us()
+        for x in range(n):
+            for (name, settings) in (('preview', preview), ('still', still)):
+                if mode == 'preset':
+                    await arducam.apply(name)
+                else:
+                    if mode == 'full':
+                        arducam.shadow.clear()
+                    await arducam.configure(**settings)
+        us = time.ticks_diff(time.ticks_us(), t)//(2*n)
+        print('switch:{} {}us waitidle {}us'.format(mode, us, arducam.waitidle_us//(2*n)))
+
+async def probe(stats):
+    # event loop latency, how late a 1ms sleep wakes up.  stats [wakeups, max us, total us]
+    while True:
+        t = time.ticks_us()
+        await asyncio.sleep_ms(1)
+        late = time.ticks_diff(time.ticks_us(), t) - 1000
+        stats[0] += 1
+        stats[1] = max(stats[1], late)
+        stats[2] += max(0, late)
+
+async def stall(arducam, n = 5):
+    import _thread
+    from threadsafe import Context
+    threaded = Context()
+    try:
+        for context in (None, threaded):
+            arducam.context   = context
+            arducam.spi_mutex = _thread.allocate_lock() if context else None
+            stats = [0, 0, 0]
+            task = asyncio.create_task(probe(stats))
+            try:
+                t = time.ticks_us()
+                for x in range(n):
+                    jpg_mv = await arducam.capture()
+                capture_us = time.ticks_diff(time.ticks_us(), t)//n
+            finally:
+                task.cancel()
+            print('threaded:{} capture {}us ({}B) loop stall max {}us mean {}us'.format(
+                    context != None, capture_us, len(jpg_mv), stats[1], stats[2]//max(1, stats[0])))
+    finally:
+        arducam.context   = None
+        arducam.spi_mutex = None
+        await threaded.stop()
+    print('fifo B/s {}'.format(arducam.fifo_rates()))
+
+async def start(sim = False):
+    spi = None
+    try:
+        if sim:
+            from arducam.sim import SimSPI, SimPin
+            spi = SimSPI()
+            cs = SimPin(spi)
+            async with ArduCam(spi = spi,
+                               cs  = cs,
+                               ) as arducam:
+                await bench(arducam, sim = spi)
+                await switch(arducam)
+                await stall(arducam)
+            return
+
+        from machine import Pin, SPI
+        from arducam.pwr import ArduCamPwr
+        spi  = SPI(1, baudrate = 8000000, sck = Pin(36), mosi = Pin(35), miso = Pin(37))
+        cs = Pin(7, Pin.OUT)
+        cs.value(1)
+
+        async with ArduCamPwr():
+            async with ArduCam(spi = spi,
+                               cs  = cs,
+                               ) as arducam:
+                await bench(arducam)
+                await switch(arducam)
+                await stall(arducam)
+    except asyncio.CancelledError:
+        raise
+    except Exception as err:
+        sys.print_exception(err)
+    finally:
+        if spi:
+            spi.deinit()
+
+def main(sim = False):
+    try:
+        asyncio.run(start(sim = sim))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        asyncio.new_event_loop()  # Clear retained state
@@ -0,0 +1,94 @@
+from .arducam import IMAGE_QUALITY_HIGH
+from .arducam import IMAGE_QUALITY_DEFAULT
+from .arducam import IMAGE_QUALITY_LOW
+
+# closed loop jpeg size control, keeps frames near a byte budget by stepping the sensor's
+# jpeg quality and, if given more than one, the resolution
+#   budget = ByteBudget(target = 20000)
+#   jpg_mv = await arducam.capture()
+#   changes = budget.observe(len(jpg_mv))
+#   if changes:
+#       await arducam.update(**changes)
+# the levels run from the smallest frames (lowest resolution, low quality) to the largest.
+# a step needs the smoothed size outside target +/- deadband for hold frames in a row
+# (hysteresis).  a step up is skipped while the level above was last seen over budget,
+# that memory expires after retry frames so a calmer scene can climb back
+class ByteBudget():
+    def __init__(self, target,              # bytes per frame
+                       deadband    = 0.2,   # fraction of target we don't react inside
+                       hold        = 3,     # frames outside the deadband before a step
+                       resolutions = None,  # resolutions to step through, small to large
+                       retry       = 50,    # frames before re-trying a level that was over budget
+                       ):
+        self.target   = target
+        self.deadband = deadband
+        self.hold     = hold
+        self.retry    = retry
+        qualities = (IMAGE_QUALITY_LOW, IMAGE_QUALITY_DEFAULT, IMAGE_QUALITY_HIGH)
+        if resolutions:
+            self.levels = [(r, q) for r in resolutions for q in qualities]
+        else:
+            self.levels = [(None, q) for q in qualities]
+        self.level = len(self.levels) - 1 # start at the top, the first frames step down
+        self.sizes = [None]*len(self.levels) # smoothed size last seen at each level
+        self.ages  = [0]*len(self.levels)    # frames since
+        self.ema   = None
+        self.count = 0 # frames outside the deadband, +over/-under
+
+        #stats
+        self.frames = 0
+        self.steps  = 0
+        self.over   = 0 # frames over target + deadband
+
+    def settings(self):
+        # configure() settings for the current level
+        (resolution, quality) = self.levels[self.level]
+        if resolution == None:
+            return {'quality' : quality}
+        return {'resolution' : resolution, 'quality' : quality}
+
+    def observe(self, nbytes):
+        # account a frame, returns settings changes for arducam.update() or None
+        self.frames += 1
+        for i in range(len(self.ages)):
+            self.ages[i] += 1
+        self.ema = nbytes if self.ema == None else (self.ema*3 + nbytes)//4
+        hi = self.target*(1 + self.deadband)
+        lo = self.target*(1 - self.deadband)
+        if nbytes > hi:
+            self.over += 1
+        if self.ema > hi:
+            self.count = max(self.count, 0) + 1
+        elif self.ema < lo:
+            self.count = min(self.count, 0) - 1
+        else:
+            self.count = 0
+        self.sizes[self.level] = self.ema
+        self.ages[self.level] = 0
+
+        level = self.level
+        if self.count >= self.hold and level > 0:
+            level -= 1
+        elif -self.count >= self.hold and level < len(self.levels) - 1:
+            above = self.sizes[level + 1]
+            if above == None or above <= hi or self.ages[level + 1] >= self.retry:
+                level += 1
+        if level == self.level:
+            return None
+        self.level = level
+        self.steps += 1
+        self.count = 0
+        self.ema = self.sizes[level] if self.ages[level] < self.retry else None
+        return self.settings()
+
+    def stats(self):
+        (resolution, quality) = self.levels[self.level]
+        return {
+            'target'     : self.target,
+            'resolution' : resolution,
+            'quality'    : quality,
+            'ema'        : self.ema,
+            'frames'     : self.frames,
+            'steps'      : self.steps,
+            'over'       : self.over,
+        }
@@ -0,0 +1,104 @@
+from . import defs as arducam_defs
+from .jpeg import parse_jpeg
+from .jpeg import BitReader
+from .jpeg import BitWriter
+from .jpeg import category
+from .jpeg import extend
+
+# lossless crop of a baseline jpeg (ie. the jpg_mv from ArduCam.capture()) to a region
+#   roi = crop(jpg_mv, x = 320, y = 160, width = 160, height = 120)
+# the rectangle is widened to whole mcus (16x8 for the mega's 4:2:2 jpegs).  the kept mcus
+# are copied bit for bit, only the dc differences are re-encoded against the new
+# neighbours and the SOF dimensions patched.  no dequantize/idct, the cost is one huffman
+# pass over the scan up to the last kept mcu row.  restart intervals (DRI) with nothing in
+# the region are skipped without decoding, the output has none.  returns a new bytearray
+def crop(jpg_mv, x, y, width, height):
+    info = parse_jpeg(jpg_mv)
+    (mw, mh, mcux, mcuy) = info.mcu_size()
+    x0 = x//mw
+    y0 = y//mh
+    x1 = min((x + width + mw - 1)//mw, mcux)
+    y1 = min((y + height + mh - 1)//mh, mcuy)
+    if width <= 0 or height <= 0 or x0 >= x1 or y0 >= y1:
+        raise ValueError('crop {},{} {}x{} outside {}x{}'.format(x, y, width, height, info.width, info.height))
+    out_w = min(info.width, x1*mw) - x0*mw
+    out_h = min(info.height, y1*mh) - y0*mh
+
+    # headers, SOF dimensions patched and DRI dropped
+    r = bytearray(jpg_mv[:info.sos_at])
+    sof = info.sof_at
+    r[sof+5] = out_h >> 8
+    r[sof+6] = out_h & 0xff
+    r[sof+7] = out_w >> 8
+    r[sof+8] = out_w & 0xff
+    if info.dri_at >= 0:
+        r = r[:info.dri_at] + r[info.dri_at+6:]
+    r += jpg_mv[info.sos_at:info.scan_at]
+
+    bits = BitReader(jpg_mv, info.scan_at)
+    w = BitWriter(r)
+    blocks  = info.mcu_blocks()
+    dcs     = [info.dc_tables[s[1]] for s in info.scan]
+    acs     = [info.ac_tables[s[2]] for s in info.scan]
+    preds   = [0]*len(info.scan) # dc predictors of the source
+    outs    = [0]*len(info.scan) # and of the output
+    restart = info.restart
+    last    = y1*mcux # nothing is kept after this mcu
+    n = 0
+    while n < last:
+        if restart and n % restart == 0:
+            if n:
+                bits.restart()
+                preds = [0]*len(info.scan)
+            end = min(n + restart, last)
+            is_kept = False
+            for k in range(n, end):
+                my = k//mcux
+                mx = k - my*mcux
+                if my >= y0 and x0 <= mx < x1:
+                    is_kept = True
+                    break
+            if not is_kept:
+                if n + restart >= last:
+                    break
+                bits.skip_interval()
+                n += restart
+                continue
+        my = n//mcux
+        mx = n - my*mcux
+        keep = my >= y0 and x0 <= mx < x1
+        for (k, count) in blocks:
+            dc_table = dcs[k]
+            ac_table = acs[k]
+            for b in range(count):
+                s = bits.decode(dc_table)
+                dc = preds[k] + extend(bits.get(s), s)
+                preds[k] = dc
+                if keep:
+                    (s, v) = category(dc - outs[k])
+                    outs[k] = dc
+                    code = dc_table[4].get(s)
+                    if code == None:
+                        raise arducam_defs.ArduCamFrameError('no dc code for category {}'.format(s))
+                    w.write(code[0], code[1])
+                    if s:
+                        w.write(v, s)
+                i = 1
+                while i < 64:
+                    rs = bits.decode(ac_table)
+                    if keep:
+                        w.write(bits.code, bits.length)
+                    s = rs & 0x0f
+                    if s:
+                        v = bits.get(s)
+                        if keep:
+                            w.write(v, s)
+                        i += (rs >> 4) + 1
+                    elif rs == 0xf0: # ZRL
+                        i += 16
+                    else: # EOB
+                        break
+        n += 1
+    w.flush()
+    r += b'\xff\xd9'
+    return r
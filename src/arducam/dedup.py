@@ -0,0 +1,34 @@
+import binascii
+
+from .jpeg import scan_start
+
+# suppress frames whose jpeg scan data is identical to the previous frame
+#   if dedup.is_dupe(jpg_mv):
+#       # skip the publish, or send a small heartbeat instead
+# only the entropy coded segment is hashed (crc32, in c), headers don't depend on the scene
+class Dedup():
+    def __init__(self, length_band = 0, # if set, frames must also fall in the same len//length_band
+                       ):
+        self.length_band = length_band
+        self.last = None
+
+        #stats
+        self.suppressed  = 0
+        self.bytes_saved = 0
+
+    def is_dupe(self, jpg_mv):
+        h = binascii.crc32(jpg_mv[scan_start(jpg_mv):])
+        if self.length_band:
+            h = (h, len(jpg_mv)//self.length_band)
+        if h == self.last:
+            self.suppressed += 1
+            self.bytes_saved += len(jpg_mv)
+            return True
+        self.last = h
+        return False
+
+    def stats(self):
+        return {
+            'suppressed'  : self.suppressed,
+            'bytes_saved' : self.bytes_saved,
+        }
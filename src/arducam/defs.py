@@ -0,0 +1,14 @@
+try:
+    #micropython
+    from micropython import const
+except:
+    #python3
+    from app.lib.micropython import const
+
+CAPTURE_TIMEOUT_MS = const(3000) # capture done must come within this, or ArduCamTimeout
+
+class ArduCamTimeout(Exception):
+    pass
+
+class ArduCamFrameError(Exception):
+    pass
@@ -0,0 +1,379 @@
+import micropython
+from micropython import const
+from array import array
+
+from . import defs as arducam_defs
+
+# jpeg markers (0xff, marker)
+_TEM  = const(0x01)
+_RST0 = const(0xd0)
+_RST7 = const(0xd7)
+_SOI  = const(0xd8)
+_EOI  = const(0xd9)
+_SOS  = const(0xda)
+_SOF0 = const(0xc0)
+_SOF1 = const(0xc1)
+_SOF2 = const(0xc2)
+_DHT  = const(0xc4)
+_DQT  = const(0xdb)
+_DRI  = const(0xdd)
+
+_LOOKAHEAD = const(9) # huffman codes up to this many bits are decoded with one table lookup
+
+# the bounds of the jpeg in buf[offset:length] -> (start, stop)
+# walks the segment markers rather than searching for SOI/EOI, so an EOI inside an embedded
+# (exif) thumbnail or stale bytes from a previous larger frame beyond length are never matched
+# raises ArduCamFrameError if the frame is truncated or malformed
+# @micropython.native
+def find_jpeg(buf, length, offset = 0):
+    start = buf.find(b'\xff\xd8', offset, length)
+    if start < 0:
+        raise arducam_defs.ArduCamFrameError('no SOI')
+    i = start + 2
+    has_sof = False
+    while True:
+        if i+2 > length:
+            raise arducam_defs.ArduCamFrameError('truncated at {}/{}'.format(i, length))
+        if buf[i] != 0xff:
+            raise arducam_defs.ArduCamFrameError('bad marker 0x{:02x} at {}'.format(buf[i], i))
+        m = buf[i+1]
+        if m == 0xff: # fill byte
+            i += 1
+            continue
+        if m == _EOI:
+            raise arducam_defs.ArduCamFrameError('EOI before scan')
+        if m == _TEM or _RST0 <= m <= _RST7: # no length
+            i += 2
+            continue
+        if i+4 > length:
+            raise arducam_defs.ArduCamFrameError('truncated at {}/{}'.format(i, length))
+        seglen = (buf[i+2]<<8) | buf[i+3]
+        if seglen < 2:
+            raise arducam_defs.ArduCamFrameError('bad segment length at {}'.format(i))
+        if _SOF0 <= m <= _SOF2:
+            has_sof = True
+        i += 2 + seglen
+        if m != _SOS:
+            continue
+        if not has_sof:
+            raise arducam_defs.ArduCamFrameError('scan before SOF')
+
+        # entropy coded data runs up to the next marker that isn't a stuffed 0xff00 or RSTn
+        while True:
+            i = buf.find(b'\xff', i, length)
+            if i < 0 or i+1 >= length:
+                raise arducam_defs.ArduCamFrameError('truncated scan, {}B'.format(length))
+            m = buf[i+1]
+            if m == 0 or _RST0 <= m <= _RST7:
+                i += 2
+                continue
+            if m == 0xff: # fill byte
+                i += 1
+                continue
+            break
+        if m == _EOI:
+            return (start, i+2)
+        # another segment (ie. progressive scans), keep walking
+
+# index of the entropy coded data (just after the SOS header) of a jpeg that starts at SOI,
+# ie. the jpg_mv from ArduCam.capture().  only the headers are walked
+# @micropython.native
+def scan_start(mv):
+    i = 2
+    lenmv = len(mv)
+    while i+4 <= lenmv:
+        if mv[i] != 0xff:
+            break
+        m = mv[i+1]
+        if m == 0xff: # fill byte
+            i += 1
+            continue
+        i += 2 + ((mv[i+2]<<8) | mv[i+3])
+        if m == _SOS:
+            return i
+    raise arducam_defs.ArduCamFrameError('no scan')
+
+# baseline huffman scan helpers, shared by arducam.crop and arducam.thumb.  they work on
+# the jpg_mv from ArduCam.capture() and never dequantize or idct a block
+
+class JpegInfo():
+    # what parse_jpeg() found in the headers
+    def __init__(self):
+        self.width      = 0
+        self.height     = 0
+        self.comps      = []   # [id, h, v, quant table] in SOF order
+        self.quant_dc   = {}   # quant table id -> dc quantizer
+        self.dc_tables  = {}   # table id -> huffman_table()
+        self.ac_tables  = {}
+        self.restart    = 0    # restart interval in mcus, 0 none
+        self.scan       = []   # (comp idx, dc table id, ac table id) in SOS order
+        self.sof_at     = 0    # index of the SOF marker
+        self.dri_at     = -1   # index of the DRI marker, -1 none
+        self.sos_at     = 0    # index of the SOS marker
+        self.scan_at    = 0    # index of the entropy coded data
+
+    def mcu_size(self):
+        # (mcu width, mcu height, mcus across, mcus down) of the scan
+        if len(self.scan) == 1:
+            # non interleaved, one block per mcu over the component's own dimensions
+            comp = self.comps[self.scan[0][0]]
+            hmax = max([c[1] for c in self.comps])
+            vmax = max([c[2] for c in self.comps])
+            cw = (self.width*comp[1] + hmax - 1)//hmax
+            ch = (self.height*comp[2] + vmax - 1)//vmax
+            return (8*hmax//comp[1], 8*vmax//comp[2], (cw + 7)//8, (ch + 7)//8)
+        mw = 8*max([c[1] for c in self.comps])
+        mh = 8*max([c[2] for c in self.comps])
+        return (mw, mh, (self.width + mw - 1)//mw, (self.height + mh - 1)//mh)
+
+    def mcu_blocks(self):
+        # [(scan idx, blocks of that component per mcu), ...]
+        if len(self.scan) == 1:
+            return [(0, 1)]
+        return [(i, self.comps[self.scan[i][0]][1]*self.comps[self.scan[i][0]][2]) for i in range(len(self.scan))]
+
+# symbol -> (code, length) for a canonical huffman table
+def huff_codes(bits, vals):
+    codes = {}
+    code = 0
+    k = 0
+    for l in range(1, 17):
+        for i in range(bits[l-1]):
+            codes[vals[k]] = (code, l)
+            code += 1
+            k += 1
+        code <<= 1
+    return codes
+
+# decode tables for a canonical huffman table
+# (lookahead array, maxcode, valptr, vals, codes), see BitReader.decode()
+def huffman_table(bits, vals):
+    codes = huff_codes(bits, vals)
+    look = array('H', bytes(2 << _LOOKAHEAD))
+    maxcode = [-1]*18
+    valptr  = [0]*17
+    code = 0
+    k = 0
+    for l in range(1, 17):
+        valptr[l] = k - code
+        if bits[l-1]:
+            code += bits[l-1]
+            k += bits[l-1]
+            maxcode[l] = code - 1
+        code <<= 1
+    maxcode[17] = 0x7fffffff
+    for (sym, (code, l)) in codes.items():
+        if l <= _LOOKAHEAD:
+            shift = _LOOKAHEAD - l
+            for j in range(code << shift, (code + 1) << shift):
+                look[j] = (l << 8) | sym
+    return (look, maxcode, valptr, bytes(vals), codes)
+
+# parse the headers of a baseline jpeg that starts at SOI, up to the first scan
+# raises ArduCamFrameError for progressive/lossless/arithmetic or malformed frames
+def parse_jpeg(mv):
+    info = JpegInfo()
+    i = 2
+    lenmv = len(mv)
+    while True:
+        if i+4 > lenmv or mv[i] != 0xff:
+            raise arducam_defs.ArduCamFrameError('no scan')
+        m = mv[i+1]
+        if m == 0xff: # fill byte
+            i += 1
+            continue
+        if m == _EOI:
+            raise arducam_defs.ArduCamFrameError('EOI before scan')
+        seglen = (mv[i+2]<<8) | mv[i+3]
+        j = i + 4
+        end = i + 2 + seglen
+        if m == _SOF0 or m == _SOF1:
+            info.sof_at = i
+            info.height = (mv[j+1]<<8) | mv[j+2]
+            info.width  = (mv[j+3]<<8) | mv[j+4]
+            for k in range(mv[j+5]):
+                c = j + 6 + 3*k
+                info.comps.append([mv[c], mv[c+1]>>4, mv[c+1]&0x0f, mv[c+2]])
+        elif 0xc1 < m <= 0xcf and m != _DHT and m != 0xc8 and m != 0xcc:
+            raise arducam_defs.ArduCamFrameError('not baseline, SOF 0x{:02x}'.format(m))
+        elif m == _DHT:
+            while j < end:
+                tc = mv[j] >> 4
+                th = mv[j] & 0x0f
+                bits = mv[j+1:j+17]
+                n = sum(bits)
+                vals = mv[j+17:j+17+n]
+                (info.ac_tables if tc else info.dc_tables)[th] = huffman_table(bits, vals)
+                j += 17 + n
+        elif m == _DQT:
+            while j < end:
+                pq = mv[j] >> 4
+                info.quant_dc[mv[j] & 0x0f] = (mv[j+1]<<8) | mv[j+2] if pq else mv[j+1]
+                j += 65 + 64*pq
+        elif m == _DRI:
+            info.dri_at  = i
+            info.restart = (mv[j]<<8) | mv[j+1]
+        elif m == _SOS:
+            if not info.comps:
+                raise arducam_defs.ArduCamFrameError('scan before SOF')
+            info.sos_at = i
+            for k in range(mv[j]):
+                c = j + 1 + 2*k
+                for idx in range(len(info.comps)):
+                    if info.comps[idx][0] == mv[c]:
+                        info.scan.append((idx, mv[c+1]>>4, mv[c+1]&0x0f))
+            info.scan_at = end
+            return info
+        i = end
+
+class BitReader():
+    # msb first bits of the entropy coded data at mv[i:], byte stuffing removed.  stops at
+    # a marker, feeding 0s, until restart() steps over an RSTn.  fill/get/decode run once
+    # per huffman symbol (thumb.thumbnail decodes every ac symbol), they are native code
+    def __init__(self, mv, i):
+        self.mv     = mv
+        self.i      = i
+        self.acc    = 0
+        self.n      = 0
+        self.marker = 0    # the marker we stopped at, 0 none
+        self.code   = 0    # the last huffman code and its length, see decode()
+        self.length = 0
+
+    @micropython.native
+    def fill(self):
+        mv = self.mv
+        i = self.i
+        acc = self.acc
+        n = self.n
+        while n <= 16:
+            b = 0
+            if not self.marker:
+                b = mv[i]
+                if b == 0xff:
+                    m = mv[i+1]
+                    if m:
+                        self.marker = m
+                        b = 0
+                    else:
+                        i += 2 # stuffed 0xff00
+                else:
+                    i += 1
+            acc = (acc << 8) | b
+            n += 8
+        self.i = i
+        self.acc = acc
+        self.n = n
+
+    @micropython.native
+    def get(self, k):
+        if k == 0:
+            return 0
+        if self.n < k:
+            self.fill()
+        self.n -= k
+        v = self.acc >> self.n
+        self.acc &= (1 << self.n) - 1
+        return v
+
+    @micropython.native
+    def decode(self, table):
+        # the next huffman symbol, its code/length are left in self.code/self.length
+        if self.n <= 16:
+            self.fill()
+        n = self.n
+        acc = self.acc
+        e = table[0][acc >> (n - _LOOKAHEAD)]
+        if e:
+            l = e >> 8
+            sym = e & 0xff
+        else:
+            maxcode = table[1]
+            l = _LOOKAHEAD + 1
+            code = acc >> (n - l)
+            while code > maxcode[l]:
+                l += 1
+                code = acc >> (n - l)
+            if l > 16:
+                raise arducam_defs.ArduCamFrameError('bad huffman code')
+            sym = table[3][table[2][l] + code]
+        self.n = n - l
+        self.code = acc >> self.n
+        self.length = l
+        self.acc = acc & ((1 << self.n) - 1)
+        return sym
+
+    def restart(self):
+        # drop the bits left in the byte and step over the RSTn we stopped at
+        self.acc = 0
+        self.n = 0
+        if not self.marker:
+            # the marker may be just past what we have read
+            mv = self.mv
+            i = self.i
+            if mv[i] == 0xff and _RST0 <= mv[i+1] <= _RST7:
+                self.marker = mv[i+1]
+        if not (_RST0 <= self.marker <= _RST7):
+            raise arducam_defs.ArduCamFrameError('missing RST at {}'.format(self.i))
+        self.i += 2
+        self.marker = 0
+
+    def skip_interval(self):
+        # skip to the RSTn ending this restart interval without decoding, see restart()
+        mv = self.mv
+        i = self.i
+        while True:
+            i = _find_ff(mv, i)
+            m = mv[i+1]
+            if _RST0 <= m <= _RST7:
+                break
+            if m and m != 0xff:
+                raise arducam_defs.ArduCamFrameError('missing RST at {}'.format(i))
+            i += 1 if m == 0xff else 2
+        self.i = i
+        self.marker = m
+        self.acc = 0
+        self.n = 0
+
+# @micropython.native
+def _find_ff(mv, i):
+    while mv[i] != 0xff:
+        i += 1
+    return i
+
+# magnitude category and extra bits of a coefficient
+def category(v):
+    a = -v if v < 0 else v
+    s = 0
+    while a:
+        s += 1
+        a >>= 1
+    return (s, v if v >= 0 else v + (1<<s) - 1)
+
+# coefficient value from its category and extra bits (jpeg EXTEND)
+def extend(bits, s):
+    if s and bits < (1 << (s - 1)):
+        return bits - (1 << s) + 1
+    return bits
+
+class BitWriter():
+    # msb first bits into a bytearray, with byte stuffing
+    def __init__(self, out = None):
+        self.out = bytearray() if out == None else out
+        self.acc = 0
+        self.n   = 0
+
+    # @micropython.native
+    def write(self, code, length):
+        self.acc = (self.acc << length) | (code & ((1<<length) - 1))
+        self.n += length
+        while self.n >= 8:
+            self.n -= 8
+            b = (self.acc >> self.n) & 0xff
+            self.out.append(b)
+            if b == 0xff:
+                self.out.append(0) # byte stuffing
+        self.acc &= (1<<self.n) - 1
+
+    def flush(self):
+        if self.n:
+            self.write((1<<(8-self.n)) - 1, 8-self.n) # pad with 1s
@@ -0,0 +1,89 @@
+import micropython
+
+# pixel kernels for raw frames from ArduCam.capture_raw() / rows(), compiled with viper
+# they work on 8 bit luma planes (after luma_*) and may run in place (dst is src), so
+# on device image analysis needs no per pixel python objects and no extra frame buffers
+#   mv = await arducam.capture_raw()   # 96x96 yuv
+#   luma_yuv422(mv, mv, 96*96)         # 96x96 luma in mv[:96*96]
+#   downscale2x(mv, mv, 96, 96)        # 48x48 luma in mv[:48*48]
+
+
+# luma plane from yuv422 (Y0 U Y1 V), n pixels -> n bytes
+@micropython.viper
+def luma_yuv422(src: ptr8, dst: ptr8, n: int):
+    for i in range(n):
+        dst[i] = src[i << 1]
+
+# luma plane from big endian rgb565, n pixels -> n bytes (bt.601 weights)
+@micropython.viper
+def luma_rgb565(src: ptr8, dst: ptr8, n: int):
+    for i in range(n):
+        p = (src[i << 1] << 8) | src[(i << 1) + 1]
+        r = (p >> 8) & 0xf8
+        g = (p >> 3) & 0xfc
+        b = (p << 3) & 0xf8
+        dst[i] = (r*77 + g*150 + b*29) >> 8
+
+# 2x2 box filter, w x h -> w//2 x h//2
+@micropython.viper
+def downscale2x(src: ptr8, dst: ptr8, w: int, h: int):
+    ow = w >> 1
+    for y in range(h >> 1):
+        s = (y << 1)*w
+        d = y*ow
+        for x in range(ow):
+            i = s + (x << 1)
+            dst[d + x] = (src[i] + src[i+1] + src[i+w] + src[i+w+1] + 2) >> 2
+
+# 4x4 box filter, w x h -> w//4 x h//4
+@micropython.viper
+def downscale4x(src: ptr8, dst: ptr8, w: int, h: int):
+    ow = w >> 2
+    for y in range(h >> 2):
+        s = (y << 2)*w
+        d = y*ow
+        for x in range(ow):
+            i = s + (x << 2)
+            acc = 0
+            for r in range(4):
+                acc += src[i] + src[i+1] + src[i+2] + src[i+3]
+                i += w
+            dst[d + x] = (acc + 8) >> 4
+
+# mean of each (1<<shift) square block, w x h -> w>>shift x h>>shift
+@micropython.viper
+def block_mean(src: ptr8, dst: ptr8, w: int, h: int, shift: int):
+    bs = 1 << shift
+    bw = w >> shift
+    bh = h >> shift
+    rnd = 0
+    if shift:
+        rnd = 1 << (shift + shift - 1)
+    for by in range(bh):
+        for bx in range(bw):
+            i = (by << shift)*w + (bx << shift)
+            acc = 0
+            for r in range(bs):
+                for c in range(bs):
+                    acc += src[i + c]
+                i += w
+            dst[by*bw + bx] = (acc + rnd) >> (shift + shift)
+
+# compare n block means against a background model, returns how many blocks differ by more
+# than threshold.  the background follows the scene, bg += (cur - bg) >> alpha_shift
+@micropython.viper
+def motion_blocks(cur: ptr8, bg: ptr8, n: int, threshold: int, alpha_shift: int) -> int:
+    changed = 0
+    for i in range(n):
+        d = int(cur[i]) - int(bg[i])
+        if d > threshold or d < 0 - threshold:
+            changed += 1
+        bg[i] = int(bg[i]) + (d >> alpha_shift)
+    return changed
+
+# 16 bin histogram of n luma bytes, hist is a zeroed array('I', 16)
+@micropython.viper
+def histogram16(src: ptr8, n: int, hist: ptr32):
+    for i in range(n):
+        j = src[i] >> 4
+        hist[j] += 1
@@ -0,0 +1,53 @@
+from .kernels import motion_blocks
+
+# gate high resolution captures on scene change in a small luma frame
+#   blocks = block means of a preview frame, see arducam.kernels.block_mean
+#   if gate.check(blocks):
+#       jpg_mv = await arducam.capture() ...
+#       gate.sent(len(jpg_mv))
+class MotionGate():
+    def __init__(self, threshold   = 12, # block mean change (0-255) that counts as motion
+                       min_blocks  = 2,  # changed blocks needed to pass
+                       alpha_shift = 3,  # background learning rate, 1/8 per check
+                       ):
+        self.threshold   = threshold
+        self.min_blocks  = min_blocks
+        self.alpha_shift = alpha_shift
+
+        # background block means, sized on the first check
+        self.background = None
+
+        #stats
+        self.gated      = 0 # checks with no motion, high res frame not captured
+        self.passed     = 0
+        self.sent_bytes = 0 # bytes of high res frames sent, see sent()
+
+    def check(self, blocks):
+        # True if the scene changed, the first frame always passes
+        if self.background == None or len(self.background) != len(blocks):
+            self.background = bytearray(blocks)
+            self.passed += 1
+            return True
+        changed = motion_blocks(blocks, self.background, len(blocks), self.threshold, self.alpha_shift)
+        if changed >= self.min_blocks:
+            self.passed += 1
+            return True
+        self.gated += 1
+        return False
+
+    def sent(self, nbytes):
+        # account a high res frame sent after a pass, for bytes_saved()
+        self.sent_bytes += nbytes
+
+    def bytes_saved(self):
+        # estimate, gated frames at the mean size of the frames we did send
+        if self.passed == 0:
+            return 0
+        return self.gated * self.sent_bytes // self.passed
+
+    def stats(self):
+        return {
+            'gated'       : self.gated,
+            'passed'      : self.passed,
+            'bytes_saved' : self.bytes_saved(),
+        }
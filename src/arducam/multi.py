@@ -0,0 +1,119 @@
+from asyncio import Lock
+import time
+
+from . import defs as arducam_defs
+from .arducam import ArduCam
+from .arducam import Frame
+
+# several ArduCam Mega modules on one spi bus, one cs pin each
+#   spi = SPI(1, baudrate = 8000000, sck = Pin(36), mosi = Pin(35), miso = Pin(37))
+#   async with MultiCam(spi = spi, cs_pins = [Pin(7, Pin.OUT), Pin(6, Pin.OUT)]) as cams:
+#       await cams.configure(resolution = RESOLUTION_640X480)
+#       async for (idx, frame) in cams:
+#           await publish(topic = cams.topic(b'sscam/pix', idx), payload = frame.jpg)
+# every camera is double buffered and visited round robin.  all of them are exposing
+# while one is read out, so aggregate fps scales with the camera count until the fifo
+# readouts fill the bus.  fifo readouts hold a shared Lock, see ArduCam.bus_lock
+class MultiCam():
+    def __init__(self, spi,
+                       cs_pins,     # one per camera, camera idx is the position in the list
+                       **kwargs,    # passed to each ArduCam
+                       ):
+        for name in ('double_buffer', 'bus_lock'):
+            if name in kwargs:
+                # round robin relies on every camera exposing while another is read out
+                raise TypeError('MultiCam sets {} itself'.format(name))
+        self.spi = spi
+        self.bus_lock = Lock()
+        if kwargs.get('context') and not kwargs.get('spi_mutex'):
+            # threaded readouts, one mutex for the whole bus
+            import _thread
+            kwargs['spi_mutex'] = _thread.allocate_lock()
+        # every cs high before talking to any camera
+        for cs in cs_pins:
+            cs(1)
+        self.cams = [ArduCam(spi           = spi,
+                             cs            = cs,
+                             double_buffer = True,
+                             bus_lock      = self.bus_lock,
+                             **kwargs) for cs in cs_pins]
+        self.idx = -1 # last camera visited
+
+        #stats
+        self.seqs     = [0 for cam in self.cams] # frames per camera
+        self.rejected = [0 for cam in self.cams] # corrupt frames per camera
+        self.timeouts = [0 for cam in self.cams]
+
+    async def start(self):
+        for cam in self.cams:
+            await cam.start()
+
+    async def stop(self):
+        for cam in self.cams:
+            await cam.stop()
+
+    async def __aenter__(self):
+        try:
+            await self.start()
+        except:
+            await self.stop()
+            raise
+        return self
+
+    async def __aexit__(self, *args):
+        await self.stop()
+
+    def __len__(self):
+        return len(self.cams)
+
+    def topic(self, base, idx):
+        # per camera topic, ie. b'sscam/pix/0'
+        return base + b'/' + str(idx).encode()
+
+    async def configure(self, **kwargs):
+        # same settings on every camera, use cams[idx].update() for one camera
+        for cam in self.cams:
+            await cam.configure(**kwargs)
+
+    async def arm(self):
+        # start every camera exposing, so the first round doesn't wait on each in turn
+        for cam in self.cams:
+            if not cam.is_armed:
+                await cam.arm()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # the next frame round robin, (camera idx, Frame).  frame.jpg is valid until that
+        # camera captures twice more.  a camera that fails is skipped this round
+        await self.arm()
+        for x in range(len(self.cams)):
+            self.idx = (self.idx + 1) % len(self.cams)
+            idx = self.idx
+            try:
+                jpg = await self.cams[idx].capture()
+            except arducam_defs.ArduCamFrameError:
+                self.rejected[idx] += 1
+                continue
+            except arducam_defs.ArduCamTimeout:
+                self.timeouts[idx] += 1
+                continue
+            self.seqs[idx] += 1
+            return (idx, Frame(seq   = self.seqs[idx],
+                               ticks = time.ticks_ms(),
+                               jpg   = jpg,
+                               ))
+        raise arducam_defs.ArduCamTimeout('no camera produced a frame')
+
+    def fps(self):
+        # (aggregate, [per camera]) frames/sec since the last call
+        fps = [cam.fps() for cam in self.cams]
+        return (sum(fps), fps)
+
+    def stats(self):
+        return {
+            'frames'   : self.seqs,
+            'rejected' : self.rejected,
+            'timeouts' : self.timeouts,
+        }
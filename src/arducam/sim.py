@@ -0,0 +1,346 @@
+import time
+from micropython import const
+
+from .jpeg import huff_codes
+from .jpeg import category
+from .jpeg import BitWriter
+
+# software stand in for the arducam mega on spi, to run/profile the ArduCam driver without
+# the module (ie. micropython unix port on linux).  models the register map, sensor busy
+# state, capture latency, fifo length/burst protocol and serves frames from a library of
+# generated sample jpegs and raw rgb565/yuv frames
+#   spi = SimSPI(capture_ms = 40)
+#   async with ArduCam(spi = spi, cs = SimPin(spi)) as arducam:
+#       ...
+#   print(spi.stats())
+
+_CAM_REG_SENSOR_ID          = const(0x40)
+_CAM_REG_SENSOR_STATE       = const(0x44)
+_CAM_REG_SENSOR_STATE_IDLE  = const(0x02)
+_CAP_DONE_MASK              = const(0x04)
+_ARDUCHIP_FIFO              = const(0x04)
+_FIFO_CLEAR_ID_MASK         = const(0x01)
+_FIFO_START_MASK            = const(0x02)
+_BURST_FIFO_READ            = const(0x3c)
+_FIFO_SIZE1                 = const(0x45)
+_FIFO_SIZE2                 = const(0x46)
+_FIFO_SIZE3                 = const(0x47)
+_CAM_REG_FORMAT             = const(0x20)
+_CAM_REG_CAPTURE_RESOLUTION = const(0x21)
+_CAM_REG_IMAGE_QUALITY      = const(0x2a)
+_CAM_SET_VIDEO_MODE         = const(0x80)
+_CAM_IMAGE_PIX_FMT_JPG      = const(0x01)
+_SENSOR_5MP_1               = const(0x81)
+
+# resolution register -> (width, height), video modes 1/2 are 320x240/640x480
+_SIZES = {
+    0x01 : (320, 240),
+    0x02 : (640, 480),
+    0x03 : (800, 600),
+    0x0a : (96, 96),
+    0x0b : (128, 128),
+    0x0c : (320, 320),
+    _CAM_SET_VIDEO_MODE | 1 : (320, 240),
+    _CAM_SET_VIDEO_MODE | 2 : (640, 480),
+}
+
+# annex k luminance huffman tables (bits per code length, values)
+_DC_BITS = (0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0)
+_DC_VALS = (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11)
+_AC_BITS = (0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7d)
+_AC_VALS = (
+    0x01, 0x02, 0x03, 0x00, 0x04, 0x11, 0x05, 0x12, 0x21, 0x31, 0x41, 0x06, 0x13, 0x51, 0x61, 0x07,
+    0x22, 0x71, 0x14, 0x32, 0x81, 0x91, 0xa1, 0x08, 0x23, 0x42, 0xb1, 0xc1, 0x15, 0x52, 0xd1, 0xf0,
+    0x24, 0x33, 0x62, 0x72, 0x82, 0x09, 0x0a, 0x16, 0x17, 0x18, 0x19, 0x1a, 0x25, 0x26, 0x27, 0x28,
+    0x29, 0x2a, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3a, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48, 0x49,
+    0x4a, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5a, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68, 0x69,
+    0x6a, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79, 0x7a, 0x83, 0x84, 0x85, 0x86, 0x87, 0x88, 0x89,
+    0x8a, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9a, 0xa2, 0xa3, 0xa4, 0xa5, 0xa6, 0xa7,
+    0xa8, 0xa9, 0xaa, 0xb2, 0xb3, 0xb4, 0xb5, 0xb6, 0xb7, 0xb8, 0xb9, 0xba, 0xc2, 0xc3, 0xc4, 0xc5,
+    0xc6, 0xc7, 0xc8, 0xc9, 0xca, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8, 0xd9, 0xda, 0xe1, 0xe2,
+    0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xe8, 0xe9, 0xea, 0xf1, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7, 0xf8,
+    0xf9, 0xfa,
+)
+
+def _segment(marker, payload):
+    n = len(payload) + 2
+    return bytes([0xff, marker, n>>8, n&0xff]) + payload
+
+# a valid baseline jpeg, flat shaded 8x8 blocks with seeded ac noise
+# noise is the number of non-zero ac coefficients per luma block, it sets the frame size
+# color is ycbcr 4:2:2 like the mega's jpegs (2x1 luma blocks per mcu), else grayscale
+# restart adds a DRI and RSTn markers every restart mcus
+def make_jpeg(width, height, seed = 1, noise = 6, color = False, restart = 0):
+    dc_codes = huff_codes(_DC_BITS, _DC_VALS)
+    ac_codes = huff_codes(_AC_BITS, _AC_VALS)
+    r = bytearray(b'\xff\xd8')
+    r += _segment(0xe0, b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00')
+    r += _segment(0xdb, bytes([0]) + bytes([8]*64))
+    if color:
+        r += _segment(0xc0, bytes([8, height>>8, height&0xff, width>>8, width&0xff, 3,
+                                   1, 0x21, 0, 2, 0x11, 0, 3, 0x11, 0]))
+    else:
+        r += _segment(0xc0, bytes([8, height>>8, height&0xff, width>>8, width&0xff, 1, 1, 0x11, 0]))
+    r += _segment(0xc4, bytes([0x00]) + bytes(_DC_BITS) + bytes(_DC_VALS))
+    r += _segment(0xc4, bytes([0x10]) + bytes(_AC_BITS) + bytes(_AC_VALS))
+    if restart:
+        r += _segment(0xdd, bytes([restart>>8, restart&0xff]))
+    if color:
+        r += _segment(0xda, bytes([3, 1, 0x00, 2, 0x00, 3, 0x00, 0, 63, 0]))
+    else:
+        r += _segment(0xda, bytes([1, 1, 0x00, 0, 63, 0]))
+
+    w = BitWriter(r)
+    rnd = [seed]
+    def block(dc, pred, noise):
+        (s, bits) = category(dc - pred)
+        (code, length) = dc_codes[s]
+        w.write(code, length)
+        if s:
+            w.write(bits, s)
+        # ac, a few small seeded coefficients in zigzag order
+        last = 0
+        for i in range(noise):
+            rnd[0] = (rnd[0]*1103515245 + 12345) & 0x7fffffff
+            pos = last + 1 + (rnd[0] >> 8) % 6
+            if pos > 63:
+                break
+            v = ((rnd[0] >> 16) % 15) - 7 or 1
+            run = pos - last - 1
+            while run > 15:
+                (code, length) = ac_codes[0xf0] # ZRL
+                w.write(code, length)
+                run -= 16
+            (s, bits) = category(v)
+            (code, length) = ac_codes[(run<<4) | s]
+            w.write(code, length)
+            w.write(bits, s)
+            last = pos
+        if last < 63:
+            (code, length) = ac_codes[0x00] # EOB
+            w.write(code, length)
+        return dc
+
+    mw = 16 if color else 8
+    bw = (width + mw - 1)//mw
+    bh = (height+7)//8
+    preds = [0, 0, 0]
+    n = 0
+    for by in range(bh):
+        for bx in range(bw):
+            if restart and n and n % restart == 0:
+                w.flush()
+                r += bytes([0xff, 0xd0 + (n//restart - 1) % 8])
+                preds = [0, 0, 0]
+            n += 1
+            # dc, a diagonal gradient, shifted by the seed
+            if color:
+                for k in range(2):
+                    preds[0] = block(((2*bx + k + by + seed) % 32)*8 - 128, preds[0], noise)
+                preds[1] = block(((bx + seed) % 8)*4 - 16, preds[1], noise//2)
+                preds[2] = block(((by + seed) % 8)*4 - 16, preds[2], noise//2)
+            else:
+                preds[0] = block(((bx + by + seed) % 32)*8 - 128, preds[0], noise)
+    w.flush()
+    r += b'\xff\xd9'
+    return r
+
+# a raw frame, 2 bytes per pixel (rgb565 or yuv422 as far as the driver is concerned)
+def make_raw(width, height, seed = 1):
+    r = bytearray(width*height*2)
+    for y in range(height):
+        i = y*width*2
+        for x in range(width):
+            v = ((x + y + seed*16) & 0xff)
+            r[i] = v
+            r[i+1] = 0x80
+            i += 2
+    return r
+
+class SimPin():
+    # stand in for the cs machine.Pin, forwards to the SimSPI
+    def __init__(self, spi):
+        self.spi = spi
+        self.v = 1
+
+    def __call__(self, v = None):
+        return self.value(v)
+
+    def value(self, v = None):
+        if v == None:
+            return self.v
+        self.v = v
+        self.spi.select(v == 0)
+
+class SimSPI():
+    def __init__(self, sensor_id  = _SENSOR_5MP_1,
+                       capture_ms = 40,  # arm to capture done, int or {resolution reg: ms}
+                       busy_ms    = 1,   # sensor busy after each sensor register write
+                       frames     = None,# {(resolution reg, format reg): [bytes, ...]} else generated
+                       variants   = 2,   # generated frames per resolution/format, served in turn
+                       ):
+        self.sensor_id  = sensor_id
+        self.capture_ms = capture_ms
+        self.busy_ms    = busy_ms
+        self.frames     = frames if frames != None else {}
+        self.variants   = variants
+
+        self.regs = bytearray(128)
+        self.regs[_CAM_REG_FORMAT] = _CAM_IMAGE_PIX_FMT_JPG
+        self.regs[_CAM_REG_CAPTURE_RESOLUTION] = 0x0a
+        self.regs[_CAM_REG_IMAGE_QUALITY] = 1
+        self.busy_until = time.ticks_ms()
+        self.done_at    = None   # ticks_ms capture done, None if not armed
+        self.frame_idx  = 0
+        self.fifo       = b''
+        self.fifo_pos   = 0
+        self.is_burst   = False
+        self.is_selected = False
+        self.cmd        = None
+
+        #stats
+        self.transactions = 0 # cs assertions
+        self.nbytes       = 0 # bytes clocked either way
+        self.state_polls  = 0 # reads of the sensor state register
+        self.captures     = 0
+
+    def stats(self):
+        return {
+            'transactions' : self.transactions,
+            'bytes'        : self.nbytes,
+            'state_polls'  : self.state_polls,
+            'captures'     : self.captures,
+        }
+
+    def deinit(self):
+        pass
+
+    def select(self, is_selected):
+        if is_selected and not self.is_selected:
+            self.transactions += 1
+            self.cmd = None
+            self.is_burst = False
+        self.is_selected = is_selected
+
+    def frame(self):
+        # the next frame from the library for the current resolution/format
+        # generated jpegs get smaller with the quality register (high 0, default 1, low 2)
+        key = (self.regs[_CAM_REG_CAPTURE_RESOLUTION], self.regs[_CAM_REG_FORMAT])
+        frames = self.frames.get(key)
+        if not frames:
+            quality = min(self.regs[_CAM_REG_IMAGE_QUALITY], 2)
+            (width, height) = _SIZES[key[0]]
+            if key[1] == _CAM_IMAGE_PIX_FMT_JPG:
+                gen = key + (quality,)
+                frames = self.frames.get(gen)
+                if not frames:
+                    frames = [make_jpeg(width, height, seed = i+1, noise = 9 - 3*quality) for i in range(self.variants)]
+                    self.frames[gen] = frames
+            else:
+                frames = [make_raw(width, height, seed = i+1) for i in range(self.variants)]
+                self.frames[key] = frames
+        self.frame_idx = (self.frame_idx + 1) % len(frames)
+        return frames[self.frame_idx]
+
+    def state(self):
+        now = time.ticks_ms()
+        r = _CAM_REG_SENSOR_STATE_IDLE if time.ticks_diff(now, self.busy_until) >= 0 else 0
+        if self.done_at != None and time.ticks_diff(now, self.done_at) >= 0:
+            if not self.fifo_pos and not self.fifo:
+                self.fifo = self.frame()
+                self.captures += 1
+            r |= _CAP_DONE_MASK
+        return r
+
+    def read_reg(self, reg):
+        if reg == _CAM_REG_SENSOR_ID:
+            return self.sensor_id
+        if reg == _CAM_REG_SENSOR_STATE:
+            self.state_polls += 1
+            return self.state()
+        if reg >= _FIFO_SIZE1 and reg <= _FIFO_SIZE3:
+            if self.done_at != None:
+                self.state() # latch the frame if done
+            return (len(self.fifo) >> (8*(reg - _FIFO_SIZE1))) & 0xff
+        return self.regs[reg]
+
+    def write_reg(self, reg, v):
+        if reg == _ARDUCHIP_FIFO:
+            if v & _FIFO_CLEAR_ID_MASK:
+                self.done_at  = None
+                self.fifo     = b''
+                self.fifo_pos = 0
+            if v & _FIFO_START_MASK:
+                ms = self.capture_ms
+                if isinstance(ms, dict):
+                    ms = ms.get(self.regs[_CAM_REG_CAPTURE_RESOLUTION], 40)
+                self.done_at = time.ticks_add(time.ticks_ms(), ms)
+            return
+        self.regs[reg] = v
+        self.busy_until = time.ticks_add(time.ticks_ms(), self.busy_ms)
+
+    # machine.SPI interface used by ArduCam
+
+    def write(self, buf):
+        self.nbytes += len(buf)
+        if self.is_burst:
+            return # dummy byte(s)
+        if self.cmd == None and len(buf) == 1 and buf[0] == _BURST_FIFO_READ:
+            self.cmd = _BURST_FIFO_READ
+            self.is_burst = True
+            return
+        if buf[0] & 0x80:
+            self.write_reg(buf[0] & 0x7f, buf[1])
+
+    def readinto(self, buf, write = 0):
+        n = len(buf)
+        self.nbytes += n
+        if not self.is_burst:
+            for i in range(n):
+                buf[i] = write
+            return
+        fifo = self.fifo
+        pos = self.fifo_pos
+        m = min(n, len(fifo) - pos)
+        if m > 0:
+            buf[:m] = fifo[pos:pos+m]
+        else:
+            m = 0
+        for i in range(m, n):
+            buf[i] = 0
+        self.fifo_pos = pos + n
+
+    def write_readinto(self, tx, rx):
+        self.nbytes += len(tx)
+        v = self.read_reg(tx[0] & 0x7f)
+        for i in range(len(rx)):
+            rx[i] = 0
+        rx[len(rx)-1] = v
+
+class SimBus():
+    # several SimSPI devices sharing one bus, each selected by its own SimPin(device)
+    #   bus = SimBus([SimSPI(), SimSPI()])
+    #   cams = MultiCam(spi = bus, cs_pins = [SimPin(d) for d in bus.devices])
+    def __init__(self, devices):
+        self.devices = devices
+
+    def selected(self):
+        for device in self.devices:
+            if device.is_selected:
+                return device
+        raise OSError('no device selected')
+
+    def stats(self):
+        return [device.stats() for device in self.devices]
+
+    def deinit(self):
+        pass
+
+    def write(self, buf):
+        self.selected().write(buf)
+
+    def readinto(self, buf, write = 0):
+        self.selected().readinto(buf, write)
+
+    def write_readinto(self, tx, rx):
+        self.selected().write_readinto(tx, rx)
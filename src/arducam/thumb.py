@@ -0,0 +1,76 @@
+import micropython
+
+from .jpeg import parse_jpeg
+from .jpeg import BitReader
+from .jpeg import extend
+
+# 1/8 scale grayscale thumbnail of a baseline jpeg (ie. the jpg_mv from ArduCam.capture())
+# from the luma dc coefficients alone, the mean of each 8x8 block.  the ac coefficients are
+# huffman decoded only to step over them, nothing is dequantized or idct'd
+#   (w, h, luma) = thumbnail(jpg_mv, buf)   # 640x480 -> 80x60 in buf
+# luma feeds arducam.kernels (block_mean, histogram16), MotionGate and AutoExposure.measure
+# like a raw preview frame would, without capturing one.  buf is re-used if big enough.
+# it still walks every ac symbol of the frame, main.start_cam(thumbs = N) runs it every
+# Nth frame and prints its cost with the other per frame stats
+@micropython.native
+def thumbnail(jpg_mv, buf = None):
+    info = parse_jpeg(jpg_mv)
+    (mw, mh, mcux, mcuy) = info.mcu_size()
+    comps = info.comps
+    hmax = max([c[1] for c in comps])
+    vmax = max([c[2] for c in comps])
+    # luma is the first component, blocks of it per mcu
+    luma = info.scan[0][0]
+    if len(info.scan) == 1:
+        (h, v) = (1, 1)
+    else:
+        (h, v) = (comps[luma][1], comps[luma][2])
+    # thumbnail size, luma blocks covering the image (mcu padding blocks are dropped)
+    width  = ((info.width*comps[luma][1] + hmax - 1)//hmax + 7)//8
+    height = ((info.height*comps[luma][2] + vmax - 1)//vmax + 7)//8
+    if buf == None or len(buf) < width*height:
+        buf = bytearray(width*height)
+    q = info.quant_dc.get(comps[luma][3], 8)
+
+    bits = BitReader(jpg_mv, info.scan_at)
+    blocks  = info.mcu_blocks()
+    dcs     = [info.dc_tables[s[1]] for s in info.scan]
+    acs     = [info.ac_tables[s[2]] for s in info.scan]
+    preds   = [0]*len(info.scan)
+    restart = info.restart
+    for n in range(mcux*mcuy):
+        if restart and n and n % restart == 0:
+            bits.restart()
+            preds = [0]*len(info.scan)
+        my = n//mcux
+        mx = n - my*mcux
+        for (k, count) in blocks:
+            dc_table = dcs[k]
+            ac_table = acs[k]
+            for b in range(count):
+                s = bits.decode(dc_table)
+                dc = preds[k] + extend(bits.get(s), s)
+                preds[k] = dc
+                if k == 0:
+                    # block mean, level shifted back
+                    x = mx*h + b % h
+                    y = my*v + b//h
+                    if x < width and y < height:
+                        p = ((dc*q) >> 3) + 128
+                        buf[y*width + x] = 0 if p < 0 else 255 if p > 255 else p
+                i = 1
+                while i < 64:
+                    rs = bits.decode(ac_table)
+                    s = rs & 0x0f
+                    if s:
+                        bits.get(s)
+                        i += (rs >> 4) + 1
+                    elif rs == 0xf0: # ZRL
+                        i += 16
+                    else: # EOB
+                        break
+    return (width, height, memoryview(buf)[:width*height])
+
+def pgm(width, height, luma):
+    # a binary pgm of a luma plane, ie. for a preview topic any image viewer opens
+    return 'P5\n{} {}\n255\n'.format(width, height).encode() + luma
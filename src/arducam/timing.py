@@ -0,0 +1,58 @@
+import time
+from array import array
+
+# per phase capture timing, us spent in each phase of the last size captures
+#   arducam = ArduCam(spi, cs, timing_len = 32)
+#   ...
+#   arducam.timing.summary() -> {'arm':(min, mean, max, p95), 'wait':(...), ...}
+# laps are ticks_us deltas into a fixed ring of array('I') per phase, no allocations
+# per capture.  the summary sorts a copy, so call it when reporting, not per frame
+
+PHASE_ARM    = 0 # fifo clear/start, includes a double buffer re-arm after readout
+PHASE_WAIT   = 1 # waiting for capture done
+PHASE_LENGTH = 2 # fifo length read
+PHASE_READ   = 3 # fifo burst readout
+PHASE_FIND   = 4 # jpeg marker search
+PHASES = ('arm', 'wait', 'length', 'read', 'find')
+
+class CaptureTiming():
+    def __init__(self, size = 32, # captures kept
+                       ):
+        self.size  = size
+        self.rings = [array('I', bytes(4*size)) for x in PHASES]
+        self.idx   = 0 # slot being recorded
+        self.count = 0 # captures recorded so far
+        self.t     = 0
+
+    def start(self):
+        # a new capture in the current slot, clear it
+        for ring in self.rings:
+            ring[self.idx] = 0
+        self.t = time.ticks_us()
+
+    def lap(self, phase):
+        # add the time since the last start/lap to phase
+        now = time.ticks_us()
+        self.rings[phase][self.idx] += time.ticks_diff(now, self.t)
+        self.t = now
+
+    def commit(self):
+        # the capture completed, keep it.  slots not committed (errors, streamed
+        # readouts) are overwritten by the next start()
+        self.idx = (self.idx + 1) % self.size
+        self.count += 1
+
+    def clear(self):
+        self.idx   = 0
+        self.count = 0
+
+    def summary(self):
+        # phase name -> (min, mean, max, p95) us over the captures in the ring
+        n = min(self.count, self.size)
+        r = {}
+        if n == 0:
+            return r
+        for phase in range(len(PHASES)):
+            us = sorted(self.rings[phase][:n])
+            r[PHASES[phase]] = (us[0], sum(us)//n, us[-1], us[(n*95 - 1)//100])
+        return r
@@ -2,19 +2,40 @@
 import asyncio
 import sys
 import gc
+import time
 from machine import Pin, SPI
 import binascii
+import json
 from asyncio import Event
 
 from arducam.pwr import ArduCamPwr
 from arducam.arducam import ArduCam
+from arducam.multi import MultiCam
 from arducam.arducam import RESOLUTION_640X480
 from arducam.arducam import RESOLUTION_96X96
+from arducam.arducam import VIDEO_MODE_640X480
+from arducam.arducam import CAM_IMAGE_PIX_FMT_JPG
+from arducam.arducam import CAM_IMAGE_PIX_FMT_YUV
+from arducam.kernels import luma_yuv422
+from arducam.kernels import block_mean
+from arducam.motion import MotionGate
+from arducam.dedup import Dedup
+from arducam.ae import AutoExposure
+from arducam.budget import ByteBudget
+from arducam.crop import crop
+from arducam.thumb import thumbnail
+from arducam.thumb import pgm
+from arducam.defs import ArduCamTimeout
+from arducam.defs import ArduCamFrameError
 
 from wifi import Wifi
 from wifi import WifiSocket
+from lib import SocketClosed
 
 from mqtt.core import MQTTCore
+from mqtt.arena import PacketArena
+from mqtt.inflight import RetryPolicy
+from mqtt.defs import QOS_ACKS_TIMEOUT_MS
 
 async def gc_coro():
     try:
@@ -26,29 +47,256 @@ async def gc_coro():
     except Exception as err:
         sys.print_exception(err)
 
-async def start_cam(publish):
+async def is_motion(arducam, gate):
+    # grab a 96x96 yuv preview, True if it differs from the background model
+    # only then switch to the high res jpg settings (register writes are diffed)
+    await arducam.update(resolution   = RESOLUTION_96X96,
+                         pixel_format = CAM_IMAGE_PIX_FMT_YUV,
+                         )
+    mv = await arducam.capture_raw()
+    luma_yuv422(mv, mv, 96*96)
+    block_mean(mv, mv, 96, 96, 3) # 12x12 means of 8x8 blocks
+    if not gate.check(mv[:12*12]):
+        return False
+    await arducam.update(resolution   = RESOLUTION_640X480,
+                         pixel_format = CAM_IMAGE_PIX_FMT_JPG,
+                         )
+    return True
+
+async def start_cam(publish,
+                    publish_stream,
+                    next_packet_id,
+                    stream = False, # stream the fifo into the socket, the frame is never in ram
+                    double_buffer = True, # expose the next frame while sending the last
+                    video  = False, # continuous video mode for live view
+                    motion = False, # only capture/send high res frames when the scene changes
+                    dedup  = True,  # don't re-send a frame identical to the last, heartbeat instead
+                    auto_exposure = False, # software ae, re-metered every 50 frames, keeps ae.json
+                    timing = True,  # publish the per phase capture timing summary every 10 frames
+                    threaded = False, # fifo readout on a worker thread, the event loop keeps running
+                    roi    = None,  # (x, y, width, height), only send this region (lossless crop)
+                    thumbs = False, # dc thumbnail of every Nth jpeg (True every one) drives motion/ae
+                                    # and a preview topic, instead of raw preview captures.  it
+                                    # huffman decodes the whole frame, see 'thumb us' for its cost
+                    budget = None,  # bytes per frame, jpeg quality follows to stay near it
+                    arena  = True,  # capture straight into preallocated publish packets
+                    max_inflight = None, # MQTTCore.max_inflight, frames awaiting puback before
+                                         # publish() blocks (None/1 waits for each one)
+                    qos_stats = None, # MQTTCore.inflight.stats, printed with the fps
+                    ):
+    context = None
     try:
         spi  = SPI(1, baudrate = 8000000, sck = Pin(36), mosi = Pin(35), miso = Pin(37))
         cs = Pin(7, Pin.OUT)
         cs.value(1)
 
+        if threaded:
+            from threadsafe import Context
+            context = Context()
+
         async with ArduCamPwr():
-            async with ArduCam(spi = spi,
-                               cs  = cs,
+            async with ArduCam(spi           = spi,
+                               cs            = cs,
+                               double_buffer = double_buffer,
+                               context       = context,
                                ) as arducam:
                 await arducam.configure(resolution = RESOLUTION_640X480,
                                         )
+                ae = AutoExposure()
+                if auto_exposure and not await ae.restore(arducam):
+                    await ae.converge(arducam)
+                if video:
+                    async with arducam.stream(mode        = VIDEO_MODE_640X480,
+                                              interval_ms = 100,
+                                              ) as frames:
+                        async for frame in frames:
+                            print('frame {} {}kB dropped {}'.format(frame.seq, len(frame.jpg)//1000, frames.dropped))
+                            qosack = await publish(topic   = b'sscam/pix',
+                                                   payload = frame.jpg,
+                                                   qos     = 1,
+                                                   )
+                            await qosack.event.wait()
+                            if frame.seq % 10 == 0:
+                                print('fps {:.2f}'.format(arducam.fps()))
+
+                frames = 0
+                rejects = 0
+                gate = MotionGate()
+                dupes = Dedup()
+                thumb_buf = bytearray(80*60)
+                sizer = ByteBudget(target = budget) if budget else None
+                if sizer:
+                    await arducam.update(**sizer.settings())
+                # a slot is captured into while the others are in flight
+                inflight = max_inflight or 1
+                packets = PacketArena(topic = b'sscam/pix', count = inflight + 1) if arena else None
+                heap = [0, 0] # bytes allocated by capture+publish, frames measured
+                thumb_us = [0, 0] # us spent in thumbnail(), thumbnails measured
+                thumbed = 0
+                still = False # no motion at the last thumbnail
+                seq = 0 # seq of the last frame sent
                 while True:
+                    frames += 1
+                    if auto_exposure and frames % 50 == 0 and not motion and not thumbs:
+                        await ae.converge(arducam)
+                    if frames % 10 == 0:
+                        print('fps {:.2f}'.format(arducam.fps()))
+                        print('capture ms {}'.format(arducam.capture_latency()))
+                        if motion:
+                            print('motion {}'.format(gate.stats()))
+                        if dedup:
+                            print('dedup {}'.format(dupes.stats()))
+                        print('fifo B/s {}'.format(arducam.fifo_rates()))
+                        print('heap {}B/frame'.format(heap[0]//max(1, heap[1])))
+                        if qos_stats:
+                            print('qos {}'.format(qos_stats()))
+                        if thumbs:
+                            print('thumb us {}'.format(thumb_us[0]//max(1, thumb_us[1])))
+                            thumb_us[0] = 0
+                            thumb_us[1] = 0
+                        heap[0] = 0
+                        heap[1] = 0
+                        if arducam.timing: # None with ArduCam(timing_len = 0)
+                            summary = arducam.timing.summary()
+                            print('timing us (min, mean, max, p95) {}'.format(summary))
+                            if timing and summary:
+                                await publish(topic   = b'sscam/stats/timing',
+                                              payload = json.dumps(summary).encode(),
+                                              qos     = 0,
+                                              )
+
+                    if stream:
+                        print('snap')
+                        try:
+                            length = await arducam.snap() # an empty/overflowed fifo raises
+                        except ArduCamTimeout as err:
+                            sys.print_exception(err)
+                            continue
+                        except ArduCamFrameError as err:
+                            rejects += 1
+                            print('reject {} {}'.format(rejects, err))
+                            continue
+                        print('stream {}kB'.format(length//1000))
+                        try:
+                            qosack = await publish_stream(topic  = b'sscam/pix',
+                                                          length = length,
+                                                          source = lambda sink: arducam.read_fifo(length, sink),
+                                                          qos    = 1,
+                                                          )
+                        except (SocketClosed, OSError, ArduCamTimeout) as err:
+                            # link down or the stream cut short, the socket reconnects.  the
+                            # frame is lost, its packet id is dropped at the ack timeout
+                            sys.print_exception(err)
+                            await asyncio.sleep_ms(1000)
+                            continue
+                        print('waiting for puback...')
+                        try:
+                            # streamed frames are not retransmitted
+                            await asyncio.wait_for_ms(qosack.event.wait(), QOS_ACKS_TIMEOUT_MS)
+                        except asyncio.TimeoutError:
+                            print('puback timeout')
+                        continue
+
                     print('capture')
-                    jpg_mv = await arducam.capture()
+                    try:
+                        if motion and not thumbs and not await is_motion(arducam, gate):
+                            await asyncio.sleep_ms(200)
+                            continue
+                        free = gc.mem_free()
+                        if packets:
+                            slot = await packets.next() # waits if its last packet is in flight
+                            (start, stop) = await arducam.capture_into(slot, packets.offset, packets.mv)
+                            jpg_mv = packets.mv[start:stop]
+                        else:
+                            jpg_mv = await arducam.capture()
+                        used = free - gc.mem_free()
+                    except ArduCamTimeout as err:
+                        sys.print_exception(err)
+                        continue
+                    except ArduCamFrameError as err:
+                        # corrupt/truncated frame, don't spend bandwidth on it
+                        rejects += 1
+                        print('reject {} {}'.format(rejects, err))
+                        continue
                     # b64 = binascii.b2a_base64(jpg_mv)
                     print('jpg {}kB'.format(len(jpg_mv)//1000))
-                    qosack = await publish(topic   = b'sscam/pix',
-                                           payload = jpg_mv,
-                                           qos     = 1,
-                                           )
-                    print('waiting for puback...')
-                    await qosack.event.wait()
+                    if sizer:
+                        changes = sizer.observe(len(jpg_mv))
+                        if changes:
+                            # jpg_mv stays valid, update() doesn't touch the fifo buffers
+                            await arducam.update(**changes)
+                            await publish(topic   = b'sscam/stats/budget',
+                                          payload = json.dumps(sizer.stats()).encode(),
+                                          qos     = 0,
+                                          retain  = True,
+                                          )
+                    if dedup and dupes.is_dupe(jpg_mv):
+                        print('unchanged')
+                        await publish(topic   = b'sscam/pix/unchanged',
+                                      payload = 'seq {}'.format(seq).encode(),
+                                      qos     = 0,
+                                      )
+                        continue
+                    if thumbs and frames % thumbs == 0:
+                        t = time.ticks_us()
+                        (width, height, luma) = thumbnail(jpg_mv, thumb_buf)
+                        thumb_us[0] += time.ticks_diff(time.ticks_us(), t)
+                        thumb_us[1] += 1
+                        thumbed += 1
+                        if auto_exposure and thumbed % 10 == 0:
+                            await ae.feedback(arducam, luma)
+                        if thumbed % 10 == 0:
+                            await publish(topic   = b'sscam/pix/preview',
+                                          payload = pgm(width, height, luma),
+                                          qos     = 0,
+                                          )
+                        if motion:
+                            block_mean(luma, luma, width, height, 3) # in place, luma is done with
+                            still = not gate.check(luma[:(width>>3)*(height>>3)])
+                    if thumbs and motion and still:
+                        # the frames between thumbnails follow the last motion check
+                        continue
+                    if roi:
+                        try:
+                            jpg_mv = crop(jpg_mv, *roi)
+                        except (ArduCamFrameError, ValueError) as err:
+                            # malformed/unsupported jpeg, or the roi is outside a smaller
+                            # resolution the budget stepped to.  same as a corrupt capture
+                            rejects += 1
+                            print('reject {} {}'.format(rejects, err))
+                            continue
+                        print('roi {}kB'.format(len(jpg_mv)//1000))
+                    seq += 1
+                    gate.sent(len(jpg_mv))
+                    free = gc.mem_free()
+                    if packets and not roi:
+                        # the header goes in front of the jpeg already in the slot
+                        packet_id = next_packet_id()
+                        qosack = await publish(topic     = b'sscam/pix', # for the retry policy
+                                               pkt       = packets.packet(start, stop, packet_id),
+                                               packet_id = packet_id,
+                                               qos       = 1,
+                                               )
+                        packets.hold(qosack) # the slot isn't captured into until it is done
+                    else:
+                        if inflight > 1 and not roi:
+                            # capture() re-uses its buffers, a frame in flight needs its own copy
+                            jpg_mv = bytes(jpg_mv)
+                        qosack = await publish(topic   = b'sscam/pix',
+                                               payload = jpg_mv,
+                                               qos     = 1,
+                                               )
+                    used += free - gc.mem_free()
+                    if used >= 0: # negative if a collection ran in between
+                        heap[0] += used
+                        heap[1] += 1
+                    if inflight <= 1:
+                        # the capture buffer is re-used next frame, wait until the
+                        # publish is done with it (acked/dropped and out of tx_q)
+                        print('waiting for puback...')
+                        await qosack.event.wait()
+                    # else publish() blocks while the window is full, packets.next() while
+                    # the slot's packet is in flight
 
 
     except asyncio.CancelledError:
@@ -56,8 +304,50 @@ async def start_cam(publish):
     except Exception as err:
         sys.print_exception(err)
     finally:
+        if context:
+            await context.stop()
         spi.deinit()
 
+async def start_multicam(publish,
+                         cs_pins = (7, 6), # one cs per camera module, all on spi1
+                         ):
+    spi = None
+    try:
+        spi  = SPI(1, baudrate = 8000000, sck = Pin(36), mosi = Pin(35), miso = Pin(37))
+
+        async with ArduCamPwr():
+            async with MultiCam(spi     = spi,
+                                cs_pins = [Pin(p, Pin.OUT) for p in cs_pins],
+                                ) as cams:
+                await cams.configure(resolution = RESOLUTION_640X480,
+                                     )
+                frames = 0
+                while True:
+                    try:
+                        async for (idx, frame) in cams:
+                            frames += 1
+                            if frames % 10 == 0:
+                                print('fps {:.2f} {}'.format(*cams.fps()))
+                                print('cams {}'.format(cams.stats()))
+                                print('fifo B/s {}'.format(cams.cams[0].fifo_rates()))
+                            print('cam {} frame {} {}kB'.format(idx, frame.seq, len(frame.jpg)//1000))
+                            qosack = await publish(topic   = cams.topic(b'sscam/pix', idx),
+                                                   payload = frame.jpg,
+                                                   qos     = 1,
+                                                   )
+                            await qosack.event.wait()
+                    except ArduCamTimeout as err:
+                        sys.print_exception(err)
+                        await asyncio.sleep_ms(1000)
+
+    except asyncio.CancelledError:
+        raise
+    except Exception as err:
+        sys.print_exception(err)
+    finally:
+        if spi:
+            spi.deinit()
+
 async def mqtt_rx_coro(rx_q):
     try:
         while True:
@@ -77,6 +367,14 @@ async def start():
         async with Wifi(addr = 0,
                         ) as wifi:
             use_ssl = False
+            multicam = False # several camera modules sharing spi1, see start_multicam()
+            inflight = 4 # frames awaiting puback, pipelines publishing over slow links
+            # a late frame is worth less than the next one, give up on them quickly
+            policies = {b'sscam/pix' : RetryPolicy(retries    = 2,
+                                                   backoff    = 2,
+                                                   max_age_ms = 10000,
+                                                   ),
+                        }
             async with WifiSocket(ifce   = wifi,
                                   host   = 'broker.hivemq.com',
                                   en_ssl = use_ssl,
@@ -84,10 +382,23 @@ async def start():
                                   ) as sock:
                 async with MQTTCore(socket    = sock,
                                     client_id = wifi.client_id,
+                                    max_inflight = inflight,
+                                    policies     = policies,
+                                    # no max_retained, the window already bounds the frames
+                                    # held for re-sends (the arena, or their copies)
                                     ) as mqtt:
                     rx_task = asyncio.create_task(mqtt_rx_coro(rx_q = mqtt.mqtt_app_rx_q))
                     await mqtt.subscribe(topics = [b'sscam/cmd/#'])
-                    cam_task = asyncio.create_task(start_cam(publish = mqtt.publish))
+                    if multicam:
+                        cam_task = asyncio.create_task(start_multicam(publish = mqtt.publish,
+                                                                      ))
+                    else:
+                        cam_task = asyncio.create_task(start_cam(publish        = mqtt.publish,
+                                                                 publish_stream = mqtt.publish_stream,
+                                                                 next_packet_id = mqtt.next_packet_id,
+                                                                 max_inflight   = mqtt.max_inflight,
+                                                                 qos_stats      = mqtt.inflight.stats,
+                                                                 ))
                     await Event().wait() # pause
     finally:
         if rx_task:
@@ -0,0 +1,69 @@
+from . import encdec as mqtt_encdec
+
+# preallocated PUBLISH packets for one topic, the payload is produced in place (ie. read
+# straight out of the camera fifo) and the header written in front of it once the payload
+# bounds are known.  no per packet allocations, no payload copies
+#   arena = PacketArena(topic = b'sscam/pix', size = 65536, count = 2)
+#   slot = await arena.next()
+#   (start, stop) = await arducam.capture_into(slot, arena.offset, arena.mv)
+#   packet_id = mqtt.next_packet_id()
+#   qosack = await mqtt.publish(pkt = arena.packet(start, stop, packet_id), packet_id = packet_id, qos = 1)
+#   arena.hold(qosack)
+# slots are used round robin.  qos 1 keeps a packet for retransmits until it is done
+# (qosack.event: acked or dropped, and no copy left in the socket's tx_q), acks arrive in
+# any order so next() waits for the packet held in a slot before handing it out again.
+# count should cover the packets in flight, ie. MQTTCore.max_inflight + 1, or next() stalls
+class PacketArena():
+    def __init__(self, topic,         # bytes
+                       size  = 65536, # payload bytes per slot, the largest frame
+                       count = 2,     # slots, used round robin
+                       qos   = 1,
+                       retain = False,
+                       ):
+        self.topic  = topic
+        self.qos    = qos
+        self.retain = retain
+        # header room, fixed byte + up to 4 remaining length bytes + topic + packet id
+        self.offset = 1 + 4 + 2 + len(topic) + 2
+        self.slots  = [bytearray(self.offset + size) for x in range(count)]
+        self.mvs    = [memoryview(slot) for slot in self.slots]
+        self.qosacks    = [None]*count # the packet in flight from each slot, see hold()
+        self.packet_ids = [0]*count
+        self.idx    = 0
+        self.mv     = self.mvs[0] # memoryview of the current slot
+
+    async def next(self):
+        # the next slot, fill the payload from self.offset on.  waits until the packet
+        # held in it is done
+        idx = (self.idx + 1) % len(self.slots)
+        qosack = self.qosacks[idx]
+        if qosack:
+            # qosacks are pooled, one that moved on to another packet id was done with ours
+            while qosack.packet_id == self.packet_ids[idx] and not qosack.event.is_set():
+                await qosack.event.wait()
+            self.qosacks[idx] = None
+        self.idx = idx
+        self.mv = self.mvs[idx]
+        return self.slots[idx]
+
+    def hold(self, qosack):
+        # the current slot's packet is in flight as qosack (None for qos 0), next() keeps
+        # the slot until it is done
+        self.qosacks[self.idx] = qosack
+        self.packet_ids[self.idx] = qosack.packet_id if qosack else 0
+
+    def packet(self, start, stop, packet_id = 0):
+        # write the header ending at start, returns the whole packet of the current slot
+        # start/stop index the slot, the payload is slot[start:stop]
+        slot = self.slots[self.idx]
+        if start < self.offset:
+            raise ValueError('payload at {} overlaps the header room'.format(start))
+        i = mqtt_encdec.encode_publish_header_into(buf         = slot,
+                                                   end         = start,
+                                                   topic       = self.topic,
+                                                   payload_len = stop - start,
+                                                   qos         = self.qos,
+                                                   retain      = self.retain,
+                                                   packet_id   = packet_id,
+                                                   )
+        return self.mv[i:stop]
@@ -8,9 +8,11 @@ import upydash as _
 from asyncio import Event
 from primitives.delay_ms import Delay_ms
 from primitives import Queue
+from primitives import Semaphore
 
 from . import defs as mqtt_defs
 from . import encdec as mqtt_encdec
+from .inflight import InFlight
 
 from lib.debug import DebugMixin
 from lib import byteify_pkt
@@ -25,6 +27,9 @@ class MQTTCore(DebugMixin):
                        will_topic = None,
                        will_msg   = None,
                        debug      = None,
+                       max_inflight = None, # qos 1 publishes awaiting puback before publish() blocks
+                       policies     = None, # topic -> RetryPolicy, None key for other topics
+                       max_retained = None, # bytes of unacked publishes held, oldest dropped past it
                        ):
         self._name  = 'MQTT'
 
@@ -46,10 +51,14 @@ class MQTTCore(DebugMixin):
 
         self.tasks = []
 
-        # list of all transmissions that we are expecting an ack for 
-        self.qosacks_table   = []
-
-        self.packet_id_incr = 0
+        # all transmissions that we are expecting an ack for, by packet id
+        # the window bounds the qos 1 publishes among them, acks free it in any order
+        self.max_inflight = max_inflight
+        self.window   = Semaphore(max_inflight) if max_inflight else None
+        self.inflight = InFlight(window       = self.window,
+                                 policies     = policies,
+                                 max_retained = max_retained,
+                                 )
 
         # track pingreq -> pingresp network delay
         self.ping_ticks_start = 0
@@ -90,13 +99,11 @@ class MQTTCore(DebugMixin):
         self.got_connack.clear()
 
         ## clear qosacks except publishes
-        self.qosacks_table[:] = _.filter(self.qosacks_table, lambda qosack: qosack.type == mqtt_defs.PUBLISH)
+        self.inflight.clear(keep = mqtt_defs.PUBLISH)
         
         self.tasks.append(asyncio.create_task(self.rx_coro()))
         self.tasks.append(asyncio.create_task(self.qosacks_coro()))
 
-        self.packet_id_incr = time.ticks_cpu()%65536
-
         await self.connect()
 
     async def connect(self):
@@ -252,20 +259,14 @@ class MQTTCore(DebugMixin):
                 if mqtt_struct.obj.return_code == mqtt_defs.CONNACK_RETURN_CODE_SUCCESS:
                     self.got_connack.set()
             elif mqtt_struct.type == mqtt_defs.PUBACK:
-                # self.debug('rx', 'PUBACK', mqtt_struct, self.qosacks_table, mqtt_struct.obj.packet_id)
-                qosack = _.find(self.qosacks_table, lambda qosack: qosack.packet_id == mqtt_struct.obj.packet_id)
-                self.qosacks_table[:] = _.filter(self.qosacks_table, lambda qosack: qosack.packet_id != mqtt_struct.obj.packet_id)
-                qosack.event.set()
+                # self.debug('rx', 'PUBACK', mqtt_struct, mqtt_struct.obj.packet_id)
+                self.inflight.ack(mqtt_struct.obj.packet_id)
             elif mqtt_struct.type == mqtt_defs.SUBACK:
                 self.debug('rx', 'SUBACK', mqtt_struct)
-                qosack = _.find(self.qosacks_table, lambda qosack: qosack.packet_id == mqtt_struct.obj.packet_id)
-                self.qosacks_table[:] = _.filter(self.qosacks_table, lambda qosack: qosack.packet_id != mqtt_struct.obj.packet_id)
-                qosack.event.set()
+                self.inflight.ack(mqtt_struct.obj.packet_id)
             elif mqtt_struct.type == mqtt_defs.UNSUBACK:
                 self.debug('rx', 'UNSUBACK', mqtt_struct)
-                qosack = _.find(self.qosacks_table, lambda qosack: qosack.packet_id == mqtt_struct.obj.packet_id)
-                self.qosacks_table[:] = _.filter(self.qosacks_table, lambda qosack: qosack.packet_id != mqtt_struct.obj.packet_id)
-                qosack.event.set()
+                self.inflight.ack(mqtt_struct.obj.packet_id)
             elif mqtt_struct.type == mqtt_defs.PINGRESP:
                 self.ping_delay_ms = time.ticks_diff(time.ticks_ms(), self.ping_ticks_start)
                 self.debug('rx', 'PINGRESP', self.ping_delay_ms,'ms')
@@ -274,41 +275,49 @@ class MQTTCore(DebugMixin):
         except Exception as err:
             sys.print_exception(err)
 
-    # Check QosAcks table for any messages that have timedout and try them again
+    # Retransmit messages whose ack didn't arrive in time, sleeps until the earliest
+    # deadline in self.inflight or until an earlier one is added
     async def qosacks_coro(self):
         #local access optimization
         publish = self.publish
         subscribe = self.subscribe
         unsubscribe = self.unsubscribe
-        sleep_ms = asyncio.sleep_ms
-        ticks_ms = time.ticks_ms
-        ticks_diff = time.ticks_diff
+        inflight = self.inflight
+        wake = inflight.wake
+        wait_for_ms = asyncio.wait_for_ms
 
         while True:
-            _timeout_ms = mqtt_defs.QOS_ACKS_TIMEOUT_MS
             try:
-                await sleep_ms(_timeout_ms)
-                now = ticks_ms()
-                # get expired
-                expireds           = _.filter(self.qosacks_table, lambda qosack: ticks_diff(now, qosack.stamp) >= _timeout_ms)
-                # get ids
-                expired_ids = _.map(expireds, lambda qosack: qosack.packet_id)
-                # remove all expired from table
-                self.qosacks_table[:] = _.filter(self.qosacks_table, lambda qosack: qosack.packet_id not in expired_ids)
-
-                for qosack in expireds:
+                wake.clear()
+                delay_ms = inflight.delay_ms()
+                if delay_ms == None:
+                    await wake.wait()
+                elif delay_ms > 0:
+                    try:
+                        await wait_for_ms(wake.wait(), delay_ms)
+                    except asyncio.TimeoutError:
+                        pass
+
+                while True:
+                    # re-sends only, expired/out of retries/streamed publishes are dropped
+                    qosack = inflight.due()
+                    if qosack == None:
+                        break
                     if qosack.type == mqtt_defs.PUBLISH:
                         await publish(pkt       = qosack.pkt,
                                       packet_id = qosack.packet_id,
                                       try_count = qosack.try_count + 1,
+                                      qos       = 1,
                                       )
-                    if qosack.type == mqtt_defs.SUBSCRIBE:
-                        await subscribe(pkt       = qosack.pkt,
+                    elif qosack.type == mqtt_defs.SUBSCRIBE:
+                        await subscribe(topics    = (),
+                                        pkt       = qosack.pkt,
                                         packet_id = qosack.packet_id,
                                         try_count = qosack.try_count + 1,
                                         )
-                    if qosack.type == mqtt_defs.UNSUBSCRIBE:
-                        await unsubscribe(pkt       = qosack.pkt,
+                    elif qosack.type == mqtt_defs.UNSUBSCRIBE:
+                        await unsubscribe(topics    = (),
+                                          pkt       = qosack.pkt,
                                           packet_id = qosack.packet_id,
                                           try_count = qosack.try_count + 1,
                                           )
@@ -319,15 +328,16 @@ class MQTTCore(DebugMixin):
                 sys.print_exception(err)
 
 
-    # @micropython.native
     def next_packet_id(self):
-        while True:
-            self.packet_id_incr = (self.packet_id_incr+1)%65536
-            has_packet_id = _.find(self.qosacks_table, lambda qosack: qosack.packet_id == self.packet_id_incr)
-            if has_packet_id == None:
-                break
-        return self.packet_id_incr
-
+        return self.inflight.next_packet_id()
+
+    # the payload (or pkt) is not copied, the socket writes the caller's buffer.  it must stay
+    # untouched until the publish is done:
+    #   qos 1, qosack.event is set.  acked (or dropped, qosack.dropped) and no copy of it
+    #          left in tx_q, a retransmit may be queued after the first copy went out
+    #   qos 0, written from tx_q, there is no signal for that.  only pass buffers that are
+    #          never re-used (ie. fresh bytes), or publish with qos 1 and await the event
+    # the returned qosack is a pooled slot, await it before the next publish(), see QOSAck
     async def publish(self, topic     = None,  #
                             payload   = None,  #
                             qos       = 0,     #
@@ -335,34 +345,86 @@ class MQTTCore(DebugMixin):
                             packet_id = None,  #
                             try_count = 1,     #
                             pkt       = None,  # if we already have the pkt (re-posting) topic/payload/qos included
+                                               # topic still selects the RetryPolicy
                             ):
         if payload != None:
             payload = byteify_pkt(payload)
-        if payload == None or len(payload) == 0 and pkt == None:
+        if pkt == None and (payload == None or len(payload) == 0):
             return
         if packet_id == None and qos != 0:
             packet_id = self.next_packet_id()
         if pkt == None:
-            pkt = mqtt_encdec.encode_publish(topic     = topic,
-                                                     payload   = payload,
-                                                     packet_id = packet_id,
-                                                     dupe      = try_count > 1,
-                                                     retain    = retain,
-                                                     qos       = qos,
-                                                     )
+            # scatter-gather, only the header is encoded and the socket writes the payload
+            # view as is, no copies of the payload
+            header = mqtt_encdec.encode_publish_header(topic       = topic,
+                                                       payload_len = len(payload),
+                                                       packet_id   = packet_id,
+                                                       dupe        = try_count > 1,
+                                                       retain      = retain,
+                                                       qos         = qos,
+                                                       )
+            pkt = (header, payload)
+        elif try_count > 1:
+            # re-delivery, set dup in the header we already have (a tuple or arena packet)
+            header = pkt[0] if isinstance(pkt, tuple) else pkt
+            header[0] |= 0x08
         #pkt = b'0\x13\x00\x06ib0/up\x10\x00\x00\x00\x01\x00\x00\x03\xfe\x00\x11'
         if qos > 0:
             #only add to qos ack if we are qos>=1
-            qosack = mqtt_defs.QOSAck(
-                type      = mqtt_defs.PUBLISH,
-                stamp     = time.ticks_ms(),
-                try_count = try_count,
-                pkt       = pkt,
-                packet_id = packet_id,
-                event     = Event(),
-            )
-            self.qosacks_table.append(qosack)
+            windowed = self.window != None and self.inflight.get(packet_id) == None
+            if windowed:
+                # a new publish waits for a free window slot, re-sends already hold one
+                await self.window.acquire()
+            qosack = self.inflight.add(type      = mqtt_defs.PUBLISH,
+                                       packet_id = packet_id,
+                                       pkt       = pkt,
+                                       try_count = try_count,
+                                       windowed  = windowed,
+                                       topic     = topic,
+                                       )
+            # the socket calls qosack once this copy is written, the slot (the window slot
+            # and the caller's buffers) isn't free before that, even if the ack is in
+            qosack.queued += 1
+            if isinstance(pkt, tuple):
+                await self.tx_q.put((pkt[0], pkt[1], qosack))
+            else:
+                await self.tx_q.put((b'', pkt, qosack))
+            return qosack
         await self.tx_q.put(pkt) #self.socket.tx_q
+
+    # publish a payload that is produced in chunks while it is being sent, the payload is
+    # never held in full (see WifiSocket.write_stream).  source(sink) must await sink(mv)
+    # for exactly length bytes.  qos 1 gets a puback but can't be retransmitted, the
+    # caller decides what to do if qosack.event isn't set within the ack timeout
+    async def publish_stream(self, topic,
+                                   length,
+                                   source,
+                                   qos       = 0,
+                                   retain    = False,
+                                   ):
+        packet_id = None
+        if qos != 0:
+            packet_id = self.next_packet_id()
+        header = mqtt_encdec.encode_publish_header(topic       = topic,
+                                                   payload_len = length,
+                                                   packet_id   = packet_id,
+                                                   retain      = retain,
+                                                   qos         = qos,
+                                                   )
+        if qos > 0:
+            if self.window:
+                await self.window.acquire()
+            qosack = self.inflight.add(type      = mqtt_defs.PUBLISH,
+                                       packet_id = packet_id,
+                                       pkt       = None,
+                                       try_count = 1,
+                                       windowed  = self.window != None,
+                                       topic     = topic,
+                                       )
+        await self.socket.write_stream(header = header,
+                                       length = length,
+                                       source = source,
+                                       )
         if qos > 0:
             return qosack
 
@@ -383,15 +445,11 @@ class MQTTCore(DebugMixin):
                                                        )
         await self.adebug('tx', 'SUBSCRIBE', topics)
         if qoss > 0:
-            qosack = mqtt_defs.QOSAck(
-                type      = mqtt_defs.SUBSCRIBE,
-                stamp     = time.ticks_ms(),
-                try_count = try_count,
-                pkt       = pkt,
-                packet_id = packet_id,
-                event     = Event(),
-            )
-            self.qosacks_table.append(qosack)
+            qosack = self.inflight.add(type      = mqtt_defs.SUBSCRIBE,
+                                       packet_id = packet_id,
+                                       pkt       = pkt,
+                                       try_count = try_count,
+                                       )
         await self.tx_q.put(pkt)#, is_priority=True) #self.socket.tx_q
         if qoss > 0:
             return qosack
@@ -411,15 +469,11 @@ class MQTTCore(DebugMixin):
                                                          )
         # await self.adebug('tx', 'UNSUBSCRIBE', topics)
         # always get unsuback
-        qosack = mqtt_defs.QOSAck(
-            type      = mqtt_defs.UNSUBSCRIBE,
-            stamp     = time.ticks_ms(),
-            try_count = try_count,
-            pkt       = pkt,
-            packet_id = packet_id,
-            event     = Event(),
-        )
-        self.qosacks_table.append(qosack)
+        qosack = self.inflight.add(type      = mqtt_defs.UNSUBSCRIBE,
+                                   packet_id = packet_id,
+                                   pkt       = pkt,
+                                   try_count = try_count,
+                                   )
         await self.tx_q.put(pkt)#, is_priority=True) #self.socket.tx_q
         return qosack
 
@@ -125,15 +125,5 @@ Mqtt_struct = collections.namedtuple('Mqtt_struct',
     ]
 )
 
-#keep track of sent items so we can retry if we don't get an ack
-QOSAck = collections.namedtuple('QOSAck',
-    [
-        'type',
-        'stamp',
-        'try_count',
-        'pkt',
-        'packet_id',
-        'event',
-    ]
-)
+# QOSAck slots, see mqtt/inflight.py
 
@@ -286,6 +286,110 @@ def encode_publish(topic,     #bytes/str/bytearray,
 
 
 
+# PUBLISH fixed header + variable header only (everything up to the payload)
+# used when the payload is sent separately, ie. streamed from the camera fifo
+# payload_len is the number of payload bytes that will follow the header
+# @micropython.native
+def encode_publish_header(topic,       #bytes/str/bytearray,
+                          payload_len, #int
+                          dupe      = False,
+                          qos       = 0,
+                          retain    = True,
+                          packet_id = None,
+                          ):
+    packet_id_len = 2 if qos == mqtt_defs.QOS_1 or qos == mqtt_defs.QOS_2 else 0
+
+    varlen = 2 + len(topic) + packet_id_len + payload_len
+    remaining_length_bytes = encode_remaining_length(varlen)
+    r = bytearray(1 + len(remaining_length_bytes) + 2 + len(topic) + packet_id_len)
+
+    header = mqtt_defs.PUBLISH
+    if dupe:
+        header |= 0x08
+    header |= (qos<<1)
+    if retain:
+        header |= 0x01
+    r[0] = header
+    offset = 1
+
+    #remaining length
+    r[offset:offset+len(remaining_length_bytes)] = remaining_length_bytes
+    offset += len(remaining_length_bytes)
+
+    #topic length
+    r[offset:offset+2] = len(topic).to_bytes(2,'big')
+    offset += 2
+
+    #topic
+    if isinstance(topic, str):
+        r[offset:offset+len(topic)] = bytes(topic, 'utf8')
+    else:
+        r[offset:offset+len(topic)] = topic
+    offset += len(topic)
+
+    #packet_id if qos1
+    if packet_id_len:
+        if packet_id == None:
+            packet_id = gen_packet_id()
+        r[offset:offset+2] = (packet_id).to_bytes(2,'big')
+    return r
+
+
+# PUBLISH header written into buf so that it ends at end, right before a payload that is
+# already in place (ie. a packet arena slot, see mqtt.arena).  nothing is allocated, topic
+# must be bytes.  returns the index the header starts at, buf[start:end+payload_len] is the
+# whole packet
+# @micropython.native
+def encode_publish_header_into(buf,
+                               end,         #index of the first payload byte
+                               topic,       #bytes/bytearray
+                               payload_len, #int
+                               dupe      = False,
+                               qos       = 0,
+                               retain    = True,
+                               packet_id = 0,
+                               ):
+    packet_id_len = 2 if qos == mqtt_defs.QOS_1 or qos == mqtt_defs.QOS_2 else 0
+    lent = len(topic)
+    varlen = 2 + lent + packet_id_len + payload_len
+
+    #remaining length bytes
+    n = 1
+    v = varlen >> 7
+    while v:
+        n += 1
+        v >>= 7
+    start = end - packet_id_len - lent - 2 - n - 1
+
+    header = mqtt_defs.PUBLISH
+    if dupe:
+        header |= 0x08
+    header |= (qos<<1)
+    if retain:
+        header |= 0x01
+    buf[start] = header
+    offset = start + 1
+
+    #remaining length
+    for idx in range(n):
+        buf[offset] = (varlen & 0x7f) | (0x80 if idx < n-1 else 0)
+        varlen >>= 7
+        offset += 1
+
+    #topic length, topic
+    buf[offset] = lent >> 8
+    buf[offset+1] = lent & 0xff
+    offset += 2
+    buf[offset:offset+lent] = topic
+    offset += lent
+
+    #packet_id if qos1
+    if packet_id_len:
+        buf[offset] = packet_id >> 8
+        buf[offset+1] = packet_id & 0xff
+    return start
+
+
 #  SUBSCRIBE example, packet_id=12, topics=('hello/world', qos=0), ('foo/bar', qos=1)
 #  FIXED
 #       *VARI*
@@ -0,0 +1,297 @@
+import time
+from heapq import heappush
+from heapq import heappop
+from asyncio import Event
+
+from . import defs as mqtt_defs
+
+# how a publish topic is retransmitted, see InFlight(policies)
+#   policies = {b'sscam/pix' : RetryPolicy(retries = 2, backoff = 2, max_age_ms = 3000)}
+# the nth re-send waits timeout_ms*backoff**n (capped at max_timeout_ms) for its ack.  a
+# publish is dropped after retries re-sends or once max_age_ms old, whichever comes first,
+# a newer frame is worth more than a late one
+class RetryPolicy():
+    def __init__(self, retries        = None,  # re-sends before giving up, None is forever
+                       backoff        = 1,     # ack timeout multiplier per re-send
+                       max_age_ms     = None,  # since the first send, None is no limit
+                       max_timeout_ms = 60000,
+                       ):
+        self.retries        = retries
+        self.backoff        = backoff
+        self.max_age_ms     = max_age_ms
+        self.max_timeout_ms = max_timeout_ms
+
+    def timeout_ms(self, timeout_ms, try_count):
+        return min(timeout_ms*self.backoff**(try_count - 1), self.max_timeout_ms)
+
+# a transmission we expect an ack for, retransmitted until acked or dropped.  slots are
+# pooled, once the event is set the slot goes back to the pool and a later add() hands it
+# (and its cleared event) to another packet.  so a caller awaits slot.event, and reads
+# slot.dropped, before its next publish/subscribe, not later.  the event is set on drops
+# too, slot.dropped tells them apart
+class QOSAck():
+    def __init__(self, inflight):
+        self.inflight  = inflight
+        self.type      = 0
+        self.stamp     = 0    # ticks_ms of the last transmission
+        self.try_count = 0
+        self.pkt       = None # None for streamed publishes, they can't be re-sent
+        self.packet_id = 0
+        self.topic     = None # publishes, selects the RetryPolicy
+        self.birth     = 0    # InFlight.now() of the first send
+        self.size      = 0    # bytes of pkt held
+        self.dropped   = False
+        self.acked     = False
+        self.queued    = 0    # copies of pkt in the socket's tx_q, not written yet
+        self.event     = Event()
+        self.gen       = 0    # matches the live heap entry, older entries are stale
+        self.windowed  = False # holds a window slot, released with the slot
+
+    def __call__(self):
+        # the socket wrote (or copied) a queued copy of pkt, see WifiSocket.tx_coro
+        self.inflight.sent(self)
+
+# transmissions in flight by packet id, with their retransmit deadlines in a min-heap
+#   inflight = InFlight()
+#   packet_id = inflight.next_packet_id()
+#   qosack = inflight.add(mqtt_defs.PUBLISH, packet_id, pkt)
+#   inflight.ack(packet_id)           # on PUBACK, sets qosack.event
+#   qosack = inflight.due()           # in the retransmit loop, None until a deadline passes
+# a slot with copies of its packet still in tx_q (qosack.queued, the socket calls the slot
+# as it writes each) stays in flight after its ack until they are written, the packet's
+# buffers (ie. an arena slot) and its window slot are only free after that
+# acks are a dict lookup and the retransmit loop sleeps until the earliest deadline
+# (see delay_ms, wake).  acked and re-armed slots leave stale heap entries behind, they
+# are dropped as they reach the top.  deadlines are on an unwrapped ms clock so the heap
+# order survives ticks_ms wrapping.  drops (retries, max age, max_retained) wait for the
+# slot's queued copies like acks do.  with a window (a primitives Semaphore the caller
+# acquires before add(windowed = True)) a slot gives its window slot back when it is acked
+# or dropped, in any order.  publishes follow the RetryPolicy of their topic (policies[None]
+# for the rest).  past max_retained bytes of held packets the oldest publishes are dropped
+class InFlight():
+    def __init__(self, timeout_ms   = mqtt_defs.QOS_ACKS_TIMEOUT_MS,
+                       window       = None,
+                       policies     = None, # topic -> RetryPolicy
+                       max_retained = None, # bytes of publish packets held for re-sends
+                       ):
+        self.timeout_ms = timeout_ms
+        self.window = window
+        self.policies = policies if policies else {}
+        self.default  = RetryPolicy() # subscribe/unsubscribe, retried forever
+        self.max_retained = max_retained
+        self.retained = 0 # bytes of pkt held by the slots in flight
+        self.table = {}   # packet_id -> QOSAck
+        self.heap  = []   # (deadline, gen, packet_id)
+        self.free  = []   # released slots, re-used oldest first
+        self.gen   = 0
+        self.packet_id = time.ticks_cpu() % 65536
+        self.wake  = Event() # set when a deadline earlier than the others is added
+        self.ticks = time.ticks_ms()
+        self.ms    = 0
+
+        #stats
+        self.retries = 0 # re-sends
+        self.dropped = 0 # out of retries
+        self.expired = 0 # past max_age_ms
+        self.evicted = 0 # dropped for max_retained
+
+    def __len__(self):
+        return len(self.table)
+
+    def now(self):
+        # unwrapped ms since the store was created
+        t = time.ticks_ms()
+        self.ms += time.ticks_diff(t, self.ticks)
+        self.ticks = t
+        return self.ms
+
+    def next_packet_id(self):
+        # 1..65535, skipping ids still in flight
+        while True:
+            self.packet_id = self.packet_id % 65535 + 1
+            if self.packet_id not in self.table:
+                return self.packet_id
+
+    def get(self, packet_id):
+        return self.table.get(packet_id)
+
+    def policy(self, qosack):
+        if qosack.type != mqtt_defs.PUBLISH:
+            return self.default
+        policy = self.policies.get(qosack.topic)
+        if policy == None:
+            policy = self.policies.get(None, self.default)
+        return policy
+
+    def add(self, type, packet_id, pkt, try_count = 1, windowed = False, topic = None):
+        # arm a retransmit deadline for packet_id, a retransmit re-arms the slot already in
+        # flight so whoever waits on its event keeps waiting on the same one
+        now = self.now()
+        qosack = self.table.get(packet_id)
+        if qosack != None:
+            self.retries += 1
+            self.retained -= qosack.size
+        else:
+            if self.free:
+                # oldest first, a caller that hasn't looked at an acked slot yet has the
+                # longest time before it is handed out again
+                qosack = self.free.pop(0)
+                qosack.event.clear()
+            else:
+                qosack = QOSAck(self)
+            qosack.windowed = windowed
+            qosack.acked    = False
+            qosack.topic    = topic
+            qosack.birth    = now
+            qosack.dropped  = False
+            self.table[packet_id] = qosack
+        qosack.type      = type
+        qosack.stamp     = time.ticks_ms()
+        qosack.try_count = try_count
+        qosack.pkt       = pkt
+        qosack.packet_id = packet_id
+        if pkt == None:
+            qosack.size = 0
+        elif isinstance(pkt, tuple): # scatter-gather (header, payload)
+            qosack.size = len(pkt[0]) + len(pkt[1])
+        else:
+            qosack.size = len(pkt)
+        self.retained += qosack.size
+        self.arm(qosack, now + self.policy(qosack).timeout_ms(self.timeout_ms, try_count))
+        if self.max_retained != None and self.retained > self.max_retained:
+            self.evict(qosack)
+        return qosack
+
+    def arm(self, qosack, deadline):
+        # (re)set the retransmit deadline of a slot in flight, capped at its max age
+        max_age_ms = self.policy(qosack).max_age_ms
+        if max_age_ms != None:
+            deadline = min(deadline, qosack.birth + max_age_ms)
+        self.gen = self.gen % 0x3fffffff + 1 # never 0, that's a slot without a deadline
+        qosack.gen = self.gen
+        if not self.heap or deadline < self.heap[0][0]:
+            self.wake.set()
+        heappush(self.heap, (deadline, self.gen, qosack.packet_id))
+
+    def evict(self, keep):
+        # drop the oldest publishes until under max_retained, keep is the one just added
+        while self.retained > self.max_retained:
+            oldest = None
+            for qosack in self.table.values():
+                if qosack is keep or not qosack.size: # acked/dropped slots are size 0
+                    continue
+                if oldest == None or qosack.birth < oldest.birth:
+                    oldest = qosack
+            if oldest == None:
+                break
+            self.evicted += 1
+            self.drop(oldest)
+
+    def ack(self, packet_id):
+        # the ack for packet_id arrived, returns its slot or None if it isn't in flight
+        qosack = self.table.get(packet_id)
+        if qosack == None or qosack.acked or qosack.dropped:
+            return None
+        qosack.acked = True
+        self.settle(qosack)
+        if qosack.queued == 0:
+            self.finish(qosack)
+        return qosack
+
+    def sent(self, qosack):
+        # a queued copy was written, an acked or dropped slot is done with its last one
+        qosack.queued -= 1
+        if qosack.queued == 0 and (qosack.acked or qosack.dropped):
+            self.finish(qosack)
+
+    def settle(self, qosack):
+        # no more re-sends, what is left in tx_q is the socket's, not held for re-sends
+        qosack.gen = 0
+        self.retained -= qosack.size
+        qosack.size = 0
+
+    def finish(self, qosack):
+        del self.table[qosack.packet_id]
+        qosack.event.set()
+        self.release(qosack)
+
+    def drop(self, qosack):
+        # give up on a slot without an ack, done once no copy of it is left in tx_q
+        if self.table.get(qosack.packet_id) is not qosack or qosack.acked or qosack.dropped:
+            return
+        qosack.dropped = True
+        self.settle(qosack)
+        if qosack.queued == 0:
+            self.finish(qosack)
+
+    def release(self, qosack):
+        self.retained -= qosack.size
+        qosack.size = 0
+        qosack.pkt = None # don't hold the payload
+        qosack.gen = 0
+        if qosack.windowed:
+            qosack.windowed = False
+            self.window.release()
+        self.free.append(qosack)
+
+    def _top(self):
+        # the live heap entry with the earliest deadline, stale ones are popped
+        heap = self.heap
+        while heap:
+            (deadline, gen, packet_id) = heap[0]
+            qosack = self.table.get(packet_id)
+            if qosack != None and qosack.gen == gen:
+                return heap[0]
+            heappop(heap)
+        return None
+
+    def delay_ms(self):
+        # ms until the earliest deadline, 0 if past, None if nothing is in flight
+        top = self._top()
+        if top == None:
+            return None
+        return max(top[0] - self.now(), 0)
+
+    def due(self):
+        # the next slot past its deadline to re-send or None.  it stays in flight, re-send
+        # it with add() (the same packet_id) or drop() it.  slots out of retries or past
+        # their max age, and streamed publishes, are dropped here
+        while True:
+            top = self._top()
+            now = self.now()
+            if top == None or top[0] > now:
+                return None
+            heappop(self.heap)
+            qosack = self.table[top[2]]
+            qosack.gen = 0 # no live deadline until re-armed
+            policy = self.policy(qosack)
+            if policy.max_age_ms != None and now - qosack.birth >= policy.max_age_ms:
+                self.expired += 1
+                self.drop(qosack)
+            elif qosack.pkt == None or (policy.retries != None and qosack.try_count > policy.retries):
+                # streamed publishes can't be re-sent at all
+                self.dropped += 1
+                self.drop(qosack)
+            elif qosack.queued:
+                # the last copy hasn't even been written (slow link), look again a timeout
+                # later instead of queueing another copy behind it
+                self.arm(qosack, now + policy.timeout_ms(self.timeout_ms, qosack.try_count))
+            else:
+                return qosack
+
+    def clear(self, keep = None):
+        # drop everything in flight except slots of type keep
+        for packet_id in list(self.table):
+            qosack = self.table[packet_id]
+            if qosack.type != keep:
+                self.drop(qosack)
+
+    def stats(self):
+        return {
+            'inflight' : len(self.table),
+            'retained' : self.retained,
+            'retries'  : self.retries,
+            'dropped'  : self.dropped,
+            'expired'  : self.expired,
+            'evicted'  : self.evicted,
+        }
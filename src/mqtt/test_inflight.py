@@ -0,0 +1,209 @@
+
+# InFlight checks, no socket or broker needed.  run with
+#   import mqtt.test_inflight
+# the clock is driven by hand so deadlines are exact
+
+import asyncio
+from primitives import Semaphore
+
+from mqtt import defs as mqtt_defs
+from mqtt.inflight import InFlight
+from mqtt.inflight import RetryPolicy
+from mqtt.arena import PacketArena
+
+PUBLISH = mqtt_defs.PUBLISH
+
+class Clock(InFlight):
+    # InFlight on a clock set by the test
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.t = 0
+
+    def now(self):
+        return self.t
+
+def pkt(n = 10):
+    return (bytearray(b'\x32\x00'), bytes(n))
+
+async def can_acquire(window):
+    try:
+        await asyncio.wait_for_ms(window.acquire(), 10)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+print('\nack')
+f = Clock(timeout_ms = 100)
+a = f.add(PUBLISH, 1, pkt())
+assert len(f) == 1 and not a.event.is_set()
+assert f.ack(1) is a
+assert a.event.is_set() and not a.dropped and len(f) == 0
+assert f.ack(1) == None # duplicate puback
+assert f.due() == None and f.delay_ms() == None
+
+print('\npooled slots re-used oldest first')
+f = Clock(timeout_ms = 100)
+a = f.add(PUBLISH, 1, pkt())
+b = f.add(PUBLISH, 2, pkt())
+f.ack(2)
+f.ack(1)
+assert f.add(PUBLISH, 3, pkt()) is b
+assert f.add(PUBLISH, 4, pkt()) is a
+assert not a.event.is_set() # cleared for its new packet
+
+print('\nnext_packet_id skips ids in flight and 0')
+f = Clock()
+f.packet_id = 65533
+f.add(PUBLISH, 65535, pkt())
+f.add(PUBLISH, 1, pkt())
+assert [f.next_packet_id() for x in range(3)] == [65534, 2, 3]
+
+print('\ndue in deadline order, acked entries skipped')
+f = Clock(timeout_ms = 100)
+a = f.add(PUBLISH, 1, pkt())
+f.t = 10
+b = f.add(PUBLISH, 2, pkt())
+f.t = 20
+c = f.add(PUBLISH, 3, pkt())
+f.ack(2)
+assert f.delay_ms() == 80
+f.t = 99
+assert f.due() == None
+f.t = 200
+assert f.due() is a
+assert f.due() is c
+assert f.due() == None
+# re-sent, the same slot is re-armed
+assert f.add(PUBLISH, 1, a.pkt, try_count = 2) is a and a.try_count == 2
+assert f.delay_ms() == 100
+
+print('\nack while a copy is queued')
+f = Clock(timeout_ms = 100)
+a = f.add(PUBLISH, 1, pkt())
+a.queued += 1
+f.ack(1)
+assert not a.event.is_set() and len(f) == 1
+assert f.next_packet_id() != 1 # id still taken
+a() # the socket wrote it
+assert a.event.is_set() and len(f) == 0
+
+print('\nno re-send while the last copy is queued')
+f = Clock(timeout_ms = 100)
+a = f.add(PUBLISH, 1, pkt())
+a.queued += 1
+f.t = 100
+assert f.due() == None # looked at again a timeout later
+assert f.delay_ms() == 100
+a()
+f.t = 200
+assert f.due() is a
+
+print('\nretries and backoff')
+f = Clock(timeout_ms = 100, policies = {b'pix' : RetryPolicy(retries = 1, backoff = 2)})
+a = f.add(PUBLISH, 1, pkt(), topic = b'pix')
+f.t = 100
+assert f.due() is a
+f.add(PUBLISH, 1, a.pkt, try_count = 2)
+f.t = 299
+assert f.due() == None
+f.t = 300
+assert f.due() == None # out of retries
+assert a.event.is_set() and a.dropped and f.dropped == 1 and len(f) == 0
+
+print('\nmax age caps the deadline, other topics retry forever')
+f = Clock(timeout_ms = 100, policies = {b'pix' : RetryPolicy(backoff = 4, max_age_ms = 250)})
+a = f.add(PUBLISH, 1, pkt(), topic = b'pix')
+o = f.add(PUBLISH, 2, pkt(), topic = b'other')
+f.t = 100
+assert f.due() is a
+assert f.due() is o
+f.add(PUBLISH, 1, a.pkt, try_count = 2)
+f.add(PUBLISH, 2, o.pkt, try_count = 2)
+assert f.delay_ms() == 100 # o, a's re-send deadline is 400 capped at 250
+f.t = 250
+assert f.due() is o
+assert f.due() == None
+assert a.dropped and f.expired == 1
+
+print('\ndrop waits for queued copies')
+f = Clock(timeout_ms = 100, policies = {None : RetryPolicy(retries = 0)})
+a = f.add(PUBLISH, 1, pkt())
+a.queued += 1
+f.t = 100
+assert f.due() == None
+assert a.dropped and not a.event.is_set() and len(f) == 1
+a()
+assert a.event.is_set() and len(f) == 0
+
+print('\nmax_retained evicts the oldest')
+f = Clock(max_retained = 30)
+a = f.add(PUBLISH, 1, pkt(10))
+f.t = 1
+b = f.add(PUBLISH, 2, pkt(10))
+f.t = 2
+c = f.add(PUBLISH, 3, pkt(10))
+assert f.evicted == 1 and a.dropped and not b.dropped and not c.dropped
+assert f.retained == 24
+f.ack(2)
+f.ack(3)
+assert f.retained == 0
+
+async def window():
+    print('\nwindow slots return on ack and drop, in any order')
+    slots = Semaphore(2)
+    f = Clock(timeout_ms = 100, window = slots, policies = {None : RetryPolicy(retries = 0)})
+    assert await can_acquire(slots)
+    a = f.add(PUBLISH, 1, pkt(), windowed = True)
+    assert await can_acquire(slots)
+    b = f.add(PUBLISH, 2, pkt(), windowed = True)
+    assert not await can_acquire(slots)
+    b.queued += 1
+    f.ack(2)
+    assert not await can_acquire(slots) # b's copy is still queued
+    b()
+    assert await can_acquire(slots)
+    c = f.add(PUBLISH, 3, pkt(), windowed = True)
+    f.t = 100
+    assert f.due() == None # a, then c, out of retries
+    assert a.dropped and c.dropped
+    assert await can_acquire(slots) and await can_acquire(slots)
+    assert not await can_acquire(slots)
+
+asyncio.run(window())
+
+async def arena():
+    print('\narena slots wait for their packet, acks in any order')
+    f = Clock(timeout_ms = 100)
+    packets = PacketArena(topic = b'pix', size = 16, count = 3)
+    qosacks = []
+    for packet_id in (1, 2):
+        await packets.next()
+        qosacks.append(f.add(PUBLISH, packet_id, packets.packet(packets.offset, packets.offset + 4, packet_id)))
+        packets.hold(qosacks[-1])
+    f.ack(2) # 1 is late
+    await packets.next() # the third slot was never used
+    async def late():
+        await asyncio.sleep_ms(20)
+        f.ack(1)
+    task = asyncio.create_task(late())
+    try:
+        await asyncio.wait_for_ms(packets.next(), 5) # 1's slot
+        assert False, 'handed out while in flight'
+    except asyncio.TimeoutError:
+        pass
+    await packets.next() # once 1 is acked
+    assert qosacks[0].event.is_set()
+    await task
+    # a pooled slot handed to another packet id doesn't hold the arena slot it left
+    f = Clock(timeout_ms = 100)
+    a = f.add(PUBLISH, 3, None)
+    packets.hold(a)
+    f.ack(3)
+    assert f.add(PUBLISH, 4, None) is a and not a.event.is_set()
+    for x in range(3):
+        await asyncio.wait_for_ms(packets.next(), 5)
+
+asyncio.run(arena())
+
+print('\nok')
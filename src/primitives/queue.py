@@ -103,3 +103,10 @@ class Queue:
             raise QueueEmpty()
         return len(self._queue[0])
 
+
+    #ssmith, the next item without getting it, ie. to look inside a (header, payload)
+    #tuple before deciding how to send it
+    def peek(self):
+        if self.empty():
+            raise QueueEmpty()
+        return self._queue[0]
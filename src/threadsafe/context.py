@@ -16,6 +16,8 @@ class Job:
 def worker(q):  # Runs forever on a core executing jobs as they arrive
     while True:
         job = q.get_sync(True)  # Block until a Job arrives
+        if job is None:  #ssmith, Context.stop(), end the thread
+            return
         job.rval = job.func(*job.args, **job.kwargs)
         job.done.set()
 
@@ -29,3 +31,7 @@ class Context:
         await self.q.put(job)  # Will pause if q is full.
         await job.done.wait()  # Pause until function has run
         return job.rval
+
+    #ssmith, end the worker thread once the jobs already queued have run
+    async def stop(self):
+        await self.q.put(None)
@@ -11,6 +11,7 @@ import time
 import errno
 import uctypes
 from asyncio import Event
+from asyncio import Lock
 from primitives import Queue
 import binascii
 import collections
@@ -23,6 +24,8 @@ from lib.debug import DebugMixin
 
 _BUSY_ERRORS = [errno.EINPROGRESS, errno.ETIMEDOUT, 118, 119]
 _SOCKET_POLL_DELAY = const(10) #slow poll delay so we don't slam
+_TX_BUFFER_LEN = const(1024*5) #coalescing buffer for small packets
+_TX_COPY_LEN = const(1024) #items up to this are coalesced, bigger ones are written as is
 
 # AP names are pre-fixes, essentially SSID.*
 APs = [
@@ -68,6 +71,10 @@ class WifiSocket(DebugMixin):
         else:
             self.tx_q   = tx_q
 
+        #held by whoever is writing to the socket (tx_coro or write_stream) so packets
+        #are never interleaved on the wire
+        self.tx_lock = Lock()
+
         #track if a socket is open or closed, used for retry methods
         #don't set these directly, use set_socket_status(is_ready=
         self.socket_down = Event()
@@ -250,64 +257,88 @@ class WifiSocket(DebugMixin):
             print('RX SOCK CLOSE', self.sock, id(self.sock))
 
     async def tx_coro(self):
+        # tx_q items are packets (bytes like) or (header, payload) tuples from a scatter-gather
+        # publish, optionally (header, payload, sent) where sent() is called once the item is
+        # written or copied, the caller's buffers are free after that.  small items are
+        # coalesced into one buffer and sent with a single write, a large payload (or packet)
+        # is written straight from the caller's memoryview
         try:
             #local access
             tx_q = self.tx_q
             tx_q_wait = tx_q.wait
             tx_q_empty = tx_q.empty
-            tx_q_peek_len = tx_q.peek_len
+            tx_q_peek = tx_q.peek
             tx_q_get = tx_q.get_nowait
             socket_up = self.socket_up
             socket_up_is_set = socket_up.is_set
             socket_down = self.socket_down
             socket_down_is_set = socket_down.is_set
-            sleep_ms = asyncio.sleep_ms
+            tx_lock = self.tx_lock
+            write = self.write
 
             #pre-allocate buffer
-            max_len = 1024*5
-            data = bytearray(max_len)
+            data = bytearray(_TX_BUFFER_LEN)
             mv = memoryview(data)
 
             cnt = 0
             idx = 0
 
             await socket_up.wait()
-            sock_write = self.sock.write
             while True:
                 idx = 0
                 cnt = 0
+                direct = None
+                direct_sent = None
                 if not socket_up_is_set() or socket_down_is_set():
                     raise Exception('Socket is closed')
                 await tx_q_wait() #wait for item without getting item
                 while True:
                     if tx_q_empty():
                         break
-                    next_len = tx_q_peek_len()
-                    if not next_len:
-                        continue
-                    if idx == 0 and next_len > max_len: #the data is bigger than the buffer -> grow the buffer
-                        max_len = next_len
-                        data = bytearray(max_len)
-                        mv = memoryview(data)
-                    if idx+next_len > max_len:
+                    item = tx_q_peek()
+                    sent = None
+                    if isinstance(item, tuple):
+                        head = item[0]
+                        body = item[1]
+                        if len(item) > 2:
+                            sent = item[2]
+                    elif len(item) > _TX_COPY_LEN:
+                        head = b''
+                        body = item
+                    else:
+                        head = item
+                        body = None
+                    copy_len = len(head)
+                    if body != None and len(body) <= _TX_COPY_LEN:
+                        copy_len += len(body)
+                    if idx+copy_len > _TX_BUFFER_LEN:
                         break
-                    mv[idx:idx+next_len] = tx_q_get()
-                    # print('tx_coro 1', next_len)
-                    idx += next_len
+                    tx_q_get()
+                    mv[idx:idx+len(head)] = head
+                    idx += len(head)
                     cnt += 1
-                n = 0
-                while n < idx:
-                    # write returns None if not successful instead of raising EAGAIN like send
-                    r = sock_write(mv[n:idx])
-                    if not r: #None or 0
-                        # print('tx_coro 2', idx-n)
-                        await sleep_ms(100)
-                    else:
-                        n += r
-                        await sleep_ms(0) #release scheduling to asyncio
-
-                #throughput
-                self.tx_count += n
+                    if body != None:
+                        if len(body) <= _TX_COPY_LEN:
+                            mv[idx:idx+len(body)] = body
+                            idx += len(body)
+                        else:
+                            # send what we have, then the payload without copying it
+                            direct = body
+                            direct_sent = sent
+                            break
+                    if sent != None:
+                        sent() # copied
+                    # print('tx_coro 1', copy_len)
+                async with tx_lock:
+                    try:
+                        if idx:
+                            await write(mv[:idx])
+                        if direct != None:
+                            await write(direct)
+                    finally:
+                        # out of tx_q either way, a failed write takes the socket down
+                        if direct_sent != None:
+                            direct_sent()
 
                     # alternative version with send.  send throws EAGAIN, requires a try block
                     # try:
@@ -337,6 +368,48 @@ class WifiSocket(DebugMixin):
                 # self.tx_q._queue.insert(0,bytes(mv[:idx])) #add unsent items back into queue
 
 
+    # write mv directly to the socket, bypassing tx_q.  caller must hold tx_lock
+    async def write(self, mv):
+        sock_write = self.sock.write
+        socket_up_is_set = self.socket_up.is_set
+        sleep_ms = asyncio.sleep_ms
+        n = 0
+        lenmv = len(mv)
+        while n < lenmv:
+            if not socket_up_is_set():
+                raise SocketClosed
+            # write returns None if not successful instead of raising EAGAIN like send
+            r = sock_write(mv[n:])
+            if not r: #None or 0
+                await sleep_ms(_SOCKET_POLL_DELAY)
+            else:
+                n += r
+                await sleep_ms(0) #release scheduling to asyncio
+        self.tx_count += n
+
+    # write header, then the length bytes produced by source in chunks as one unit on the wire
+    # source is an async callable, source(sink), that awaits sink(mv) for each chunk
+    # the payload is never held in full, we only need ram for one chunk at a time
+    async def write_stream(self, header, length, source):
+        async with self.tx_lock:
+            count = 0
+            is_done = False
+            try:
+                await self.write(header)
+                async def sink(mv):
+                    nonlocal count
+                    count += len(mv)
+                    await self.write(mv)
+                await source(sink)
+                if count != length:
+                    # the connection is reset below, same as losing it mid stream
+                    raise SocketClosed('stream length mismatch {}!={}'.format(count, length))
+                is_done = True
+            finally:
+                if not is_done:
+                    # the broker is expecting length bytes, a partial stream corrupts the connection
+                    self.set_socket_status(is_ready = False)
+
     def get_socket_info(self, host, port):
         # Note this blocks if DNS lookup occurs. Do it once to prevent
         # blocking during later internet outage: